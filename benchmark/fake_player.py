@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+
+# License: https://raw.githubusercontent.com/Bleuzen/SpotRec/master/LICENSE
+
+# Stand-in for the Spotify client: an MPRIS player on the session bus which plays a scripted playlist
+# of generated tones into a pulse sink (through pacat), so SpotRec can be run and measured without Spotify
+#
+# Every track is a sine tone with its own frequency which starts at phase 0 at the beginning of the track,
+# so the recordings can be checked sample by sample (see run.py)
+#
+# Commands are read from stdin, one per line: "play", "pause", "quit"
+# "ready" is printed to stdout as soon as the bus name is owned
+
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+import subprocess
+import argparse
+import logging
+import math
+import time
+import sys
+import os
+
+app_name = "FakePlayer"
+
+# Settings with Defaults
+_bus_name = "org.mpris.MediaPlayer2.spotify"
+_tracks = 5
+_track_length = 20.0
+_device = None
+
+# Hard-coded settings
+_sample_rate = 44100
+_channels = 2
+_frame_bytes = 4  # s16le stereo
+_amplitude = 0.5
+_periods = [100, 80, 60, 50, 40, 30]  # Frames per period of the track tones (441 Hz - 1470 Hz)
+_pump_interval_ms = 10
+_prebuffer_seconds = 0.1
+_max_chunk_frames = 4410
+_previous_restart_threshold = 3.0  # Like Spotify: Previous jumps to the beginning after this time
+_idle_trackid = "spotify:track:fakeplayeridle"
+
+mpris_path = "/org/mpris/MediaPlayer2"
+mpris_root_string = "org.mpris.MediaPlayer2"
+mpris_player_string = "org.mpris.MediaPlayer2.Player"
+properties_string = "org.freedesktop.DBus.Properties"
+
+log = logging.getLogger()
+
+
+class Track:
+    def __init__(self, number: int, length: float, period: int):
+        self.number = number
+        self.frames = int(length * _sample_rate)
+        self.period = period
+        self.trackid = f"spotify:track:fakeplayer{number:04d}"
+        self.title = f"Tone {number:02d}"
+
+        # One period of the tone, repeated so that any chunk can be sliced out of it
+        one_period = bytearray()
+        for i in range(period):
+            sample = int(round(_amplitude * 32767 * math.sin(2 * math.pi * i / period)))
+            one_period += sample.to_bytes(2, "little", signed=True) * _channels
+        self.wave = bytes(one_period) * (_max_chunk_frames // period + 2)
+
+    @property
+    def frequency(self):
+        return _sample_rate / self.period
+
+    def pcm(self, position: int, frames: int):
+        offset = position % self.period * _frame_bytes
+        return self.wave[offset:offset + frames * _frame_bytes]
+
+    def metadata(self):
+        return dbus.Dictionary({
+            "mpris:trackid": dbus.String(self.trackid),
+            "mpris:length": dbus.UInt64(self.frames * 1000000 // _sample_rate),
+            "mpris:artUrl": dbus.String(""),
+            "xesam:title": dbus.String(self.title),
+            "xesam:album": dbus.String("SpotRec Benchmark"),
+            "xesam:artist": dbus.Array(["SpotRec Benchmark"], signature="s"),
+            "xesam:trackNumber": dbus.Int32(self.number),
+        }, signature="sv")
+
+
+def create_playlist(tracks: int, length: float):
+    return [Track(i + 1, length, _periods[i % len(_periods)]) for i in range(tracks)]
+
+
+class FakePlayer(dbus.service.Object):
+    def __init__(self, bus, playlist):
+        dbus.service.Object.__init__(self, bus, mpris_path)
+        self.playlist = playlist
+        # None until playback is started for the first time
+        self.index = None
+        self.playing = False
+        # Frames of the current track which were already written
+        self.position = 0
+
+        device = ["--device=" + _device] if _device else []
+        self.pacat = subprocess.Popen(["pacat", "--playback", "--raw", "--format=s16le",
+                                       f"--rate={_sample_rate}", f"--channels={_channels}",
+                                       "--client-name=Spotify", "--stream-name=Spotify",
+                                       "--property=application.name=spotify",
+                                       f"--property=application.process.id={os.getpid()}",
+                                       "--latency-msec=50"] + device,
+                                      stdin=subprocess.PIPE)
+
+        self.clock_start = time.monotonic()
+        self.frames_written = 0
+        GLib.timeout_add(_pump_interval_ms, self.pump)
+
+    # Writes audio in real time: the current track while playing, silence while paused
+    def pump(self):
+        due = int((time.monotonic() - self.clock_start + _prebuffer_seconds) * _sample_rate)
+
+        while self.frames_written < due:
+            frames = min(due - self.frames_written, _max_chunk_frames)
+            track = self.current_track()
+
+            if self.playing:
+                frames = min(frames, track.frames - self.position)
+                data = track.pcm(self.position, frames)
+                self.position += frames
+            else:
+                data = bytes(frames * _frame_bytes)
+
+            try:
+                self.pacat.stdin.write(data)
+            except BrokenPipeError:
+                log.error(f"[{app_name}] pacat exited")
+                loop.quit()
+                return False
+            self.frames_written += frames
+
+            if self.playing and self.position >= track.frames:
+                self.track_finished()
+
+        self.pacat.stdin.flush()
+        return True
+
+    def current_track(self):
+        return self.playlist[self.index or 0]
+
+    def track_finished(self):
+        if self.index + 1 < len(self.playlist):
+            self.load(self.index + 1, True)
+        else:
+            # Spotify jumps back to the first track and pauses at the end of a playlist
+            log.info(f"[{app_name}] Playlist ended")
+            self.load(0, False)
+
+    def load(self, index: int, playing: bool):
+        self.index = index
+        self.position = 0
+        self.playing = playing
+        log.info(f"[{app_name}] Track {self.current_track().title} ({self.status()})")
+        self.PropertiesChanged(mpris_player_string, {
+            "Metadata": self.metadata(),
+            "PlaybackStatus": self.status(),
+        }, [])
+
+    def set_playing(self, playing: bool):
+        if self.index is None:
+            if playing:
+                self.load(0, True)
+            return
+
+        if self.playing != playing:
+            self.playing = playing
+            log.info(f"[{app_name}] {self.status()}")
+            self.PropertiesChanged(mpris_player_string, {
+                "PlaybackStatus": self.status(),
+            }, [])
+
+    def seek_to(self, position: int):
+        self.position = max(0, min(position, self.current_track().frames - 1))
+        self.Seeked(dbus.Int64(self.position_us()))
+
+    def status(self):
+        return "Playing" if self.playing else "Paused"
+
+    def metadata(self):
+        metadata = self.current_track().metadata()
+        if self.index is None:
+            metadata["mpris:trackid"] = dbus.String(_idle_trackid)
+        return metadata
+
+    def position_us(self):
+        return self.position * 1000000 // _sample_rate
+
+    def properties(self):
+        return {
+            "PlaybackStatus": dbus.String(self.status()),
+            "Metadata": self.metadata(),
+            "Position": dbus.Int64(self.position_us()),
+            "Rate": dbus.Double(1.0),
+            "Volume": dbus.Double(1.0),
+            "CanGoNext": True,
+            "CanGoPrevious": True,
+            "CanPlay": True,
+            "CanPause": True,
+            "CanSeek": True,
+            "CanControl": True,
+        }
+
+    def root_properties(self):
+        return {
+            "Identity": dbus.String(app_name),
+            "CanQuit": False,
+            "CanRaise": False,
+            "HasTrackList": False,
+            "SupportedUriSchemes": dbus.Array([], signature="s"),
+            "SupportedMimeTypes": dbus.Array([], signature="s"),
+        }
+
+    # org.mpris.MediaPlayer2.Player
+
+    @dbus.service.method(mpris_player_string)
+    def Play(self):
+        self.set_playing(True)
+
+    @dbus.service.method(mpris_player_string)
+    def Pause(self):
+        self.set_playing(False)
+
+    @dbus.service.method(mpris_player_string)
+    def PlayPause(self):
+        self.set_playing(not self.playing)
+
+    @dbus.service.method(mpris_player_string)
+    def Stop(self):
+        self.set_playing(False)
+
+    @dbus.service.method(mpris_player_string)
+    def Next(self):
+        if self.index is None:
+            return
+        if self.index + 1 < len(self.playlist):
+            self.load(self.index + 1, self.playing)
+        elif self.playing:
+            self.track_finished()
+
+    @dbus.service.method(mpris_player_string)
+    def Previous(self):
+        if self.index is None:
+            return
+        if self.position >= _previous_restart_threshold * _sample_rate or self.index == 0:
+            self.seek_to(0)
+        else:
+            self.load(self.index - 1, self.playing)
+
+    @dbus.service.method(mpris_player_string, in_signature="x")
+    def Seek(self, offset):
+        self.seek_to(self.position + int(offset) * _sample_rate // 1000000)
+
+    @dbus.service.method(mpris_player_string, in_signature="ox")
+    def SetPosition(self, trackid, position):
+        self.seek_to(int(position) * _sample_rate // 1000000)
+
+    # Any URI plays the playlist from the beginning (for the job queue of spotrec --daemon)
+    @dbus.service.method(mpris_player_string, in_signature="s")
+    def OpenUri(self, uri):
+        log.info(f"[{app_name}] Open {uri}")
+        self.load(0, True)
+
+    @dbus.service.signal(mpris_player_string, signature="x")
+    def Seeked(self, position):
+        pass
+
+    # org.mpris.MediaPlayer2
+
+    @dbus.service.method(mpris_root_string)
+    def Raise(self):
+        pass
+
+    @dbus.service.method(mpris_root_string)
+    def Quit(self):
+        pass
+
+    # org.freedesktop.DBus.Properties
+
+    @dbus.service.method(properties_string, in_signature="ss", out_signature="v")
+    def Get(self, interface, prop):
+        return self.GetAll(interface)[prop]
+
+    @dbus.service.method(properties_string, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        if interface == mpris_player_string:
+            return self.properties()
+        if interface == mpris_root_string:
+            return self.root_properties()
+        raise dbus.exceptions.DBusException(
+            "org.freedesktop.DBus.Error.UnknownInterface", interface)
+
+    @dbus.service.method(properties_string, in_signature="ssv")
+    def Set(self, interface, prop, value):
+        pass
+
+    @dbus.service.signal(properties_string, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def close(self):
+        try:
+            self.pacat.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.pacat.terminate()
+        self.pacat.wait()
+
+
+def handle_args():
+    global _bus_name
+    global _tracks
+    global _track_length
+    global _device
+
+    parser = argparse.ArgumentParser(
+        description="MPRIS player which plays a playlist of generated tones, for benchmarking SpotRec")
+    parser.add_argument("--bus-name", help="Default: " + _bus_name, default=_bus_name)
+    parser.add_argument("--tracks", help="Number of tracks in the playlist\n"
+                                         "Default: " + str(_tracks), type=int, default=_tracks)
+    parser.add_argument("--length", help="Length of every track in seconds\n"
+                                         "Default: " + str(_track_length), type=float, default=_track_length)
+    parser.add_argument("--device", help="Pulse sink to play to (Default: the default sink)", default=_device)
+
+    args = parser.parse_args()
+
+    _bus_name = args.bus_name
+    _tracks = args.tracks
+    _track_length = args.length
+    _device = args.device
+
+
+def main():
+    global loop
+
+    handle_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    player = FakePlayer(bus, create_playlist(_tracks, _track_length))
+    name = dbus.service.BusName(_bus_name, bus, do_not_queue=True)  # noqa: F841 (keeps the name owned)
+
+    loop = GLib.MainLoop()
+
+    def on_command(source, condition):
+        line = sys.stdin.readline()
+        command = line.strip()
+        if not line or command == "quit":
+            loop.quit()
+            return False
+        if command == "play":
+            player.set_playing(True)
+        elif command == "pause":
+            player.set_playing(False)
+        return True
+
+    GLib.io_add_watch(sys.stdin, GLib.IO_IN | GLib.IO_HUP, on_command)
+
+    print("ready", flush=True)
+    log.info(f"[{app_name}] {_bus_name}: {_tracks} tracks of {_track_length} s")
+
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    player.close()
+
+
+if __name__ == "__main__":
+    main()
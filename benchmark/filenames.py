@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# License: https://raw.githubusercontent.com/Bleuzen/SpotRec/master/LICENSE
+
+# Microbenchmark of the file name rendering (FilenameTemplate in spotrec.py)
+#
+# Renders the names for a generated corpus of track metadata and compares it with the old rendering
+# (str.format and re.sub). Also counts the names which the old rendering got wrong:
+# longer than 255 bytes or with characters which are not allowed in file names.
+#
+# Example:
+#  benchmark/filenames.py --tracks 100000 --underscored
+
+import argparse
+import random
+import time
+import sys
+import re
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import spotrec  # noqa: E402
+
+app_name = "FilenameBenchmark"
+
+# Settings with Defaults
+_tracks = 100000
+_renders_per_track = 1
+_pattern = spotrec._filename_pattern
+_underscored = False
+_charset = "posix"
+_seed = 1
+
+# Hard-coded settings
+_words = ["Love", "Night", "Remix", "Live", "feat.", "Radio Edit", "Part II", "(Acoustic)", "[Remastered 2011]",
+          "Don't", "Stop", "AC/DC", "Mr. Brightside", "Sigur Rós", "Beyoncé", "坂本龍一", "Тату", "🎵", "What?",
+          "Who: Me", "\"Quoted\"", "Back\\Slash", "<Tag>", "A|B", "Star*", "Tab\there", "Nul\x00Byte", "Ends."]
+_long_title_share = 0.02  # Some classical tracks have very long titles
+_illegal_chars = {
+    "posix": re.compile(r'[\x00-\x1f\x7f]'),
+    "fat": re.compile(r'[\x00-\x1f\x7f\\:*?"<>|]'),
+}
+
+
+def handle_args():
+    global _tracks
+    global _renders_per_track
+    global _pattern
+    global _underscored
+    global _charset
+
+    parser = argparse.ArgumentParser(description="Microbenchmark of the SpotRec file name rendering")
+    parser.add_argument("--tracks", help="Number of tracks in the corpus (Default: " + str(_tracks) + ")",
+                        type=int, default=_tracks)
+    parser.add_argument("--renders", help="Renders per track (Default: " + str(_renders_per_track) + ")",
+                        type=int, default=_renders_per_track)
+    parser.add_argument("--pattern", help="Filename pattern (Default: \"" + _pattern + "\")", default=_pattern)
+    parser.add_argument("--underscored", help="Like --underscored-filenames", action="store_true", default=_underscored)
+    parser.add_argument("--charset", help="Like --filename-charset (Default: " + _charset + ")",
+                        choices=spotrec._filename_charsets, default=_charset)
+
+    args = parser.parse_args()
+
+    _tracks = args.tracks
+    _renders_per_track = args.renders
+    _pattern = args.pattern
+    _underscored = args.underscored
+    _charset = args.charset
+
+
+def create_corpus(tracks: int):
+    rng = random.Random(_seed)
+    artists = [" ".join(rng.choices(_words, k=rng.randint(1, 3))) for _ in range(tracks // 20 + 1)]
+    albums = [" ".join(rng.choices(_words, k=rng.randint(1, 4))) for _ in range(tracks // 10 + 1)]
+
+    corpus = []
+    for i in range(tracks):
+        words = rng.randint(40, 80) if rng.random() < _long_title_share else rng.randint(1, 6)
+        corpus.append({
+            "trackid": f"spotify:track:{i:022d}",
+            "artist": rng.choice(artists),
+            "album": rng.choice(albums),
+            "trackNumber": str(rng.randint(1, 30)).zfill(2),
+            "title": " ".join(rng.choices(_words, k=words)),
+        })
+    return corpus
+
+
+# The rendering before FilenameTemplate (Spotify.get_track())
+def render_old(track):
+    if _underscored:
+        filename_pattern = re.sub(" - ", "__", _pattern)
+    else:
+        filename_pattern = _pattern
+
+    ret = str(filename_pattern.format(
+        artist=track["artist"].replace("/", "_"),
+        album=track["album"].replace("/", "_"),
+        trackNumber=track["trackNumber"],
+        title=track["title"].replace("/", "_")
+    ))
+
+    if _underscored:
+        ret = ret.replace(".", "").lower()
+        ret = re.sub(r"[\s\-\[\]()']+", "_", ret)
+        ret = re.sub("__+", "__", ret)
+
+    return ret
+
+
+def is_broken(path: str):
+    return any(len(component.encode("utf-8")) > 255 or _illegal_chars[_charset].search(component)
+               for component in path.split("/"))
+
+
+def measure(name: str, corpus, render):
+    start = time.perf_counter()
+    paths = []
+    for track in corpus:
+        for _ in range(_renders_per_track):
+            path = render(track)
+        paths.append(path)
+    seconds = time.perf_counter() - start
+    calls = len(corpus) * _renders_per_track
+    broken = sum(1 for path in paths if is_broken(path))
+    print(f"{name:<28} {seconds * 1000000 / calls:8.2f} us/call {seconds:8.2f} s total {broken:8} unsafe names")
+
+
+def main():
+    handle_args()
+
+    corpus = create_corpus(_tracks)
+    print(f"[{app_name}] {_tracks} tracks, {_renders_per_track} renders per track, pattern \"{_pattern}\"")
+
+    measure("old (format + re.sub)", corpus, render_old)
+
+    template = spotrec.FilenameTemplate(_pattern, _underscored, _charset)
+    measure("FilenameTemplate", corpus, template.render)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+
+# License: https://raw.githubusercontent.com/Bleuzen/SpotRec/master/LICENSE
+
+# End-to-end benchmark of SpotRec against the fake player (fake_player.py)
+#
+# Runs on a private session bus (dbus-run-session) and starts its own pulse server if none is running,
+# so it also works on a headless CI machine. Reports per track:
+#  - overhead: recorded length minus track length (seconds)
+#  - boundary error: recorded samples of the track minus its real length (negative = audio is missing)
+#  - bleed: audio of other tracks in the recording (seconds)
+# and for the whole run the CPU time of SpotRec and its FFmpeg processes per recorded hour,
+# and the highest thread and process counts
+#
+# Example (arguments after "--" are passed to SpotRec):
+#  benchmark/run.py --tracks 5 --length 20 --json result.json -- --gapless
+
+import subprocess
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import re
+import os
+from threading import Thread
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+app_name = "SpotRecBenchmark"
+
+# Settings with Defaults
+_tracks = 5
+_track_length = 20.0
+_spotrec = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "spotrec.py")
+_fake_player = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_player.py")
+_json_file = None
+_keep_output = False
+_spotrec_args = []
+
+# Hard-coded settings
+_sample_rate = 44100
+_output_sink_name = "spotrec-benchmark"
+_recording_sink_name = "spotrec"
+_sample_interval = 0.5
+_timeout_per_track = 30.0
+_startup_timeout = 15.0
+_block_seconds = 0.01
+_loud_threshold = 0.05  # Level of a block that counts as audio (the tones have 0.5)
+_match_tolerance = 0.1  # Relative to the tone amplitude
+_frequency_tolerance = 0.1
+_periods = [100, 80, 60, 50, 40, 30]  # Same as in fake_player.py
+_bus_env = "SPOTREC_BENCHMARK_BUS"
+
+
+def log(message: str):
+    print(f"[{app_name}] {message}", file=sys.stderr, flush=True)
+
+
+def handle_args():
+    global _tracks
+    global _track_length
+    global _spotrec
+    global _json_file
+    global _keep_output
+    global _spotrec_args
+
+    argv = sys.argv[1:]
+    if "--" in argv:
+        _spotrec_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of SpotRec with a fake MPRIS player\n"
+                                                 "Arguments after \"--\" are passed to SpotRec",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--tracks", help="Number of tracks to record\n"
+                                         "Default: " + str(_tracks), type=int, default=_tracks)
+    parser.add_argument("--length", help="Length of every track in seconds\n"
+                                         "Default: " + str(_track_length), type=float, default=_track_length)
+    parser.add_argument("--spotrec", help="Path of spotrec.py\n"
+                                          "Default: " + _spotrec, default=_spotrec)
+    parser.add_argument("--json", help="Also write the results as JSON to this file", default=_json_file)
+    parser.add_argument("--keep-output", help="Keep the recordings (their directory is printed)",
+                        action="store_true", default=_keep_output)
+
+    args = parser.parse_args(argv)
+
+    _tracks = args.tracks
+    _track_length = args.length
+    _spotrec = args.spotrec
+    _json_file = args.json
+    _keep_output = args.keep_output
+
+
+# Restarts the benchmark on its own session bus, so no real Spotify (or other SpotRec) interferes
+def ensure_private_bus():
+    if os.environ.get(_bus_env):
+        return
+    os.environ[_bus_env] = "1"
+    os.execvp("dbus-run-session", ["dbus-run-session", "--", sys.executable] + sys.argv)
+
+
+def pulse_running():
+    return subprocess.run(["pactl", "info"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+# Returns the pulse server process if one had to be started
+def ensure_pulse_server():
+    if pulse_running():
+        return None
+
+    log("Starting a pulse server")
+    server = subprocess.Popen(["pulseaudio", "--daemonize=no", "--exit-idle-time=-1", "-n",
+                               "--load=module-native-protocol-unix",
+                               "--load=module-null-sink sink_name=benchmark-default"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + _startup_timeout
+    while not pulse_running():
+        if time.monotonic() > deadline or server.poll() is not None:
+            sys.exit("Error: Could not start a pulse server")
+        time.sleep(0.1)
+    return server
+
+
+def pactl(*args):
+    return subprocess.check_output(["pactl"] + list(args), encoding="utf-8").strip()
+
+
+def sink_exists(name: str):
+    return any(line.split("\t")[1] == name for line in pactl("list", "short", "sinks").split("\n") if "\t" in line)
+
+
+# Samples the thread and process counts of SpotRec (the process and all its children)
+class ResourceSampler(Thread):
+    def __init__(self, pid: int):
+        Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.running = True
+        self.max_threads = 0
+        self.max_processes = 0
+
+    def run(self):
+        while self.running:
+            processes = self.descendants() + [self.pid]
+            threads = sum(self.thread_count(pid) for pid in processes)
+            self.max_threads = max(self.max_threads, threads)
+            self.max_processes = max(self.max_processes, len(processes))
+            time.sleep(_sample_interval)
+
+    def descendants(self):
+        children = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # The command name in parentheses may contain spaces
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+        result = []
+        pending = [self.pid]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                result.append(child)
+                pending.append(child)
+        return result
+
+    @staticmethod
+    def thread_count(pid: int):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def stop(self):
+        self.running = False
+
+
+def decode(path: str):
+    pcm = subprocess.check_output(["ffmpeg", "-v", "error", "-i", path,
+                                   "-f", "s16le", "-ac", "1", "-ar", str(_sample_rate), "pipe:1"],
+                                  stdin=subprocess.DEVNULL)
+    return numpy.frombuffer(pcm, dtype="<i2").astype(numpy.float64) / 32768
+
+
+# Finds the run of the expected tone in a recording, see fake_player.py for how the tones are generated
+def analyze(path: str, track_number: int, length: float):
+    period = _periods[(track_number - 1) % len(_periods)]
+    expected = int(length * _sample_rate)
+    x = decode(path)
+    result = {
+        "file": path,
+        "duration": round(len(x) / _sample_rate, 3),
+        "overhead": round(len(x) / _sample_rate - length, 3),
+    }
+
+    # Blocks with audio and blocks with the expected frequency (by counting zero crossings)
+    block = int(_sample_rate * _block_seconds)
+    blocks = len(x) // block
+    if blocks == 0:
+        return result
+    framed = x[:blocks * block].reshape(blocks, block)
+    rms = numpy.sqrt(numpy.mean(framed * framed, axis=1))
+    crossings = numpy.count_nonzero(numpy.diff(numpy.signbit(framed), axis=1), axis=1)
+    frequency = crossings / 2 / _block_seconds
+    loud = rms > _loud_threshold
+    own = loud & (numpy.abs(frequency - _sample_rate / period) < _frequency_tolerance * _sample_rate / period)
+    if not own.any():
+        result["bleed"] = round(float(numpy.count_nonzero(loud)) * _block_seconds, 3)
+        return result
+
+    # Fit the phase and amplitude of the tone in the middle of the own blocks
+    own_blocks = numpy.flatnonzero(own)
+    middle = int(own_blocks[len(own_blocks) // 2]) * block
+    window = block // period * period
+    n = numpy.arange(middle, middle + window)
+    sin_part = numpy.dot(x[middle:middle + window], numpy.sin(2 * numpy.pi * n / period))
+    cos_part = numpy.dot(x[middle:middle + window], numpy.cos(2 * numpy.pi * n / period))
+    amplitude = 2 * numpy.hypot(sin_part, cos_part) / window
+    phase = numpy.arctan2(cos_part, sin_part)
+    model = amplitude * numpy.sin(2 * numpy.pi * numpy.arange(len(x)) / period + phase)
+    mismatch = numpy.abs(x - model) > _match_tolerance * amplitude
+
+    # The tone ends where several samples in a row do not match it (silence or another tone)
+    run = max(3, period // 8)
+    broken = numpy.flatnonzero(numpy.convolve(mismatch, numpy.ones(run, dtype=int), "valid") == run)
+    before = broken[broken < middle]
+    after = broken[broken >= middle]
+    start = int(before[-1]) + run if len(before) else 0
+    end = int(after[0]) if len(after) else len(x)
+    matched = numpy.flatnonzero(~mismatch[start:end])
+    if len(matched):
+        start, end = start + int(matched[0]), start + int(matched[-1]) + 1
+
+    outside = numpy.ones(blocks, dtype=bool)
+    outside[start // block:-(-end // block)] = False
+
+    result.update({
+        "lead": round(start / _sample_rate, 3),
+        "tail": round((len(x) - end) / _sample_rate, 3),
+        "boundary_error": end - start - expected,
+        "bleed": round(float(numpy.count_nonzero(loud & outside & ~own)) * _block_seconds, 3),
+    })
+    return result
+
+
+def find_recording(output_directory: str, track_number: int):
+    pattern = re.compile(rf"tone[ _]0*{track_number}\b", re.IGNORECASE)
+    for root, dirs, files in os.walk(output_directory):
+        for name in sorted(files):
+            if pattern.search(name) and not name.endswith(".jsonl"):
+                return os.path.join(root, name)
+    return None
+
+
+def summarize(tracks, cpu_seconds: float, wall_seconds: float, sampler: ResourceSampler):
+    recorded = [t for t in tracks if "duration" in t]
+    bounded = [t for t in recorded if "boundary_error" in t]
+    recorded_hours = sum(t["duration"] for t in recorded) / 3600
+
+    summary = {
+        "tracks": len(tracks),
+        "recorded": len(recorded),
+        "overhead_mean": round(sum(t["overhead"] for t in recorded) / len(recorded), 3) if recorded else None,
+        "overhead_max": max((t["overhead"] for t in recorded), default=None),
+        "boundary_error_mean_abs": round(sum(abs(t["boundary_error"]) for t in bounded) / len(bounded), 1) if bounded else None,
+        "boundary_error_max_abs": max((abs(t["boundary_error"]) for t in bounded), default=None),
+        "bleed_total": round(sum(t.get("bleed", 0) for t in recorded), 3),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_seconds_per_recorded_hour": round(cpu_seconds / recorded_hours, 1) if recorded_hours else None,
+        "wall_seconds": round(wall_seconds, 1),
+        "max_threads": sampler.max_threads,
+        "max_processes": sampler.max_processes,
+    }
+    return summary
+
+
+def print_results(tracks, summary):
+    print(f"{'track':>5} {'overhead s':>10} {'lead s':>7} {'tail s':>7} {'boundary err':>12} {'bleed s':>7}")
+    for number, t in enumerate(tracks, start=1):
+        if "duration" not in t:
+            print(f"{number:>5} {'missing':>10}")
+            continue
+        print(f"{number:>5} {t['overhead']:>10} {t.get('lead', '-'):>7} {t.get('tail', '-'):>7} "
+              f"{t.get('boundary_error', '-'):>12} {t.get('bleed', '-'):>7}")
+    print()
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+def main():
+    handle_args()
+
+    if numpy is None:
+        sys.exit("Error: The 'numpy' python module is needed to analyze the recordings.")
+
+    ensure_private_bus()
+    pulse_server = ensure_pulse_server()
+
+    output_sink_id = pactl("load-module", "module-null-sink", "sink_name=" + _output_sink_name)
+    output_directory = tempfile.mkdtemp(prefix="spotrec-benchmark-")
+    player = None
+    spotrec = None
+
+    try:
+        player = subprocess.Popen([sys.executable, _fake_player, "--tracks", str(_tracks),
+                                   "--length", str(_track_length), "--device", _output_sink_name],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding="utf-8")
+        if player.stdout.readline().strip() != "ready":
+            sys.exit("Error: The fake player did not start")
+
+        start = time.monotonic()
+        spotrec = subprocess.Popen([sys.executable, _spotrec, "--skip-intro", "--mute-recording",
+                                    "--output-directory", output_directory,
+                                    "--metrics-file", os.path.join(output_directory, "metrics.jsonl")] + _spotrec_args)
+        sampler = ResourceSampler(spotrec.pid)
+        sampler.start()
+
+        # Start playing when SpotRec is ready (its sink exists)
+        deadline = time.monotonic() + _startup_timeout
+        while not sink_exists(_recording_sink_name):
+            if time.monotonic() > deadline or spotrec.poll() is not None:
+                sys.exit("Error: SpotRec did not start")
+            time.sleep(0.1)
+        time.sleep(1)
+        log(f"Playing {_tracks} tracks of {_track_length} s")
+        player.stdin.write("play\n")
+        player.stdin.flush()
+
+        # SpotRec exits on its own when the playlist ended
+        deadline = time.monotonic() + _tracks * (_track_length + _timeout_per_track)
+        while True:
+            pid, status, rusage = os.wait4(spotrec.pid, os.WNOHANG)
+            if pid:
+                spotrec.returncode = os.waitstatus_to_exitcode(status)
+                break
+            if time.monotonic() > deadline:
+                log("Timeout, stopping SpotRec")
+                spotrec.terminate()
+                deadline = float("inf")
+            time.sleep(0.1)
+        wall_seconds = time.monotonic() - start
+        sampler.stop()
+
+        # The resource usage of SpotRec includes its FFmpeg processes (they were waited for)
+        cpu_seconds = rusage.ru_utime + rusage.ru_stime
+
+        tracks = []
+        for number in range(1, _tracks + 1):
+            path = find_recording(output_directory, number)
+            tracks.append(analyze(path, number, _track_length) if path else {"file": None})
+
+        summary = summarize(tracks, cpu_seconds, wall_seconds, sampler)
+        summary["spotrec_args"] = _spotrec_args
+        print_results(tracks, summary)
+
+        if _json_file:
+            with open(_json_file, "w") as f:
+                json.dump({"summary": summary, "tracks": tracks}, f, indent=2)
+    finally:
+        if spotrec is not None and spotrec.poll() is None:
+            spotrec.kill()
+        if player is not None:
+            player.stdin.close()
+            player.wait()
+        pactl("unload-module", output_sink_id)
+        if pulse_server is not None:
+            pulse_server.terminate()
+        if _keep_output:
+            log(f"Recordings: {output_directory}")
+        else:
+            shutil.rmtree(output_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,10 @@ import dbus.mainloop.glib
 from gi.repository import GLib
 from pathlib import Path
 
-from threading import Thread
+from threading import Thread, Condition, Lock, Event, get_native_id, current_thread, main_thread
+from collections import OrderedDict, deque
 import subprocess
+import queue
 import time
 import sys
 import shutil
@@ -17,18 +19,45 @@ import re
 import os
 import argparse
 import traceback
+import signal
 import logging
 import shlex
+import string
+import select
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import socket
+import hashlib
+import json
+import mimetypes
+import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import struct
+import base64
+import itertools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import pulsectl
+except ImportError:
+    pulsectl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Deps:
 # 'python'
 # 'python-dbus'
 # 'ffmpeg'
-# 'gawk': awk in command to get sink input id of spotify
-# 'pulseaudio': sink control stuff
-# 'bash': shell commands
+# 'pulseaudio': sink control stuff, parec for --continuous-capture
 # 'requests': get album art
+# 'pulsectl' (optional): native PulseAudio/PipeWire client for --native-pulse
+# 'numpy' (optional): silence detection for --trim-silence
 
 # TODO:
 # - set fixed latency on pipewire (currently only done by ffmpeg while it is recording ("fragment_size" parameter), but should ideally be set before recording)
@@ -43,8 +72,55 @@ _mute_pa_recording_sink = False
 _output_directory = f"{Path.home()}/{app_name}"
 _filename_pattern = "{trackNumber} - {artist} - {title}"
 _underscored_filenames = False
+_filename_charset = "posix"
 _use_internal_track_counter = False
 _add_cover_art = False
+_continuous_capture = False
+_capture_backend = "parec"
+_gapless = False
+_native_pulse = False
+_post_processing_workers = 1
+_cover_cache_directory = os.path.join(os.environ.get(
+    "XDG_CACHE_HOME", f"{Path.home()}/.cache"), app_name.lower(), "covers")
+_cover_cache_size = 100  # MiB
+_output_format = "flac"
+_flac_compression_level = 5
+_bitrate = "160k"
+_transcode_format = None
+_adaptive_timing = False
+_ffmpeg_stop_timeout = 1.0
+_trim_silence = False
+_silence_threshold = -60.0  # dBFS
+_skip_recorded = False
+_metrics_file = None
+_metrics_port = None
+_players = None  # Default: only Spotify.dbus_dest
+_daemon = False
+_staging_directory = None
+_min_free_space = 1024  # MiB
+_verify_processes = os.cpu_count() or 1
+_replaygain_tags = True
+_control_socket = os.path.join(os.environ.get(
+    "XDG_RUNTIME_DIR", "/tmp"), app_name.lower() + ".sock")
+
+# Output profiles: FFmpeg codec options, file extension and how the cover art is embedded
+#  "flac": PICTURE block written by FlacMetadata
+#  "attached_pic": remux with the image as attached picture stream
+#  "vorbis_comment": remux with a METADATA_BLOCK_PICTURE comment (Ogg)
+_output_profiles = {
+    "flac": {"codec": "-acodec flac -compression_level {flac_level}", "extension": "flac", "cover_art": "flac"},
+    "opus": {"codec": "-acodec libopus -b:a {bitrate}", "extension": "opus", "cover_art": "vorbis_comment"},
+    "mp3": {"codec": "-acodec libmp3lame -b:a {bitrate} -id3v2_version 3", "extension": "mp3", "cover_art": "attached_pic"},
+    "aac": {"codec": "-acodec aac -b:a {bitrate}", "extension": "m4a", "cover_art": "attached_pic"},
+}
+
+# Characters in the values from Spotify which are replaced in the file names (control characters are always removed)
+#  "posix": what can't be in a file name on Linux
+#  "fat": also what FAT/exFAT/NTFS (e.g. backup drives) don't allow
+_filename_charsets = {
+    "posix": {"/": "_"},
+    "fat": {"/": "_", "\\": "_", ":": "-", "*": "_", "?": "", "\"": "'", "<": "_", ">": "_", "|": "_"},
+}
 
 # Hard-coded settings
 _pa_recording_sink_name = "spotrec"
@@ -52,25 +128,64 @@ _pa_max_volume = "65536"
 _recording_time_before_song = 0.25
 _recording_time_after_song = 1.25
 _playback_time_before_seeking_to_beginning = 5.0
-_shell_executable = "/bin/bash"  # Default: "/bin/sh"
+_ffmpeg_reap_interval_ms = 10
+_signal_coalesce_ms = 50  # Spotify sends several PropertiesChanged signals per track change within a few ms
+_encoder_attempts = 2
+_spotify_previous_restart_threshold = 3.0  # Spotify only jumps to the beginning on Previous after this time
+_adaptive_timing_min_samples = 5
+_silence_frame_seconds = 0.01
+_silence_margin = 0.05  # Keep a little silence at the borders
+_track_length_tolerance = 2.0
+_trim_tail_tolerance = 0.25  # Audio longer than reported by Spotify is cut at the end
+_recording_index_filename = ".spotrec-index.jsonl"
+_verify_cache_filename = ".spotrec-verify.jsonl"
+_replaygain_reference_loudness = -18.0  # LUFS (ReplayGain 2.0)
+_filename_max_bytes = 255 - 32  # Leaves room for the "." prefix, the extension, temp file and collision suffixes
 _shell_encoding = "utf-8"
 _ffmpeg_executable = "ffmpeg"  # Example: "/usr/bin/ffmpeg"
+_pcm_sample_rate = 44100
+_pcm_channels = 2
+_pcm_sample_width = 2  # s16le
+_capture_buffer_seconds = 60
+_gapless_position_tolerance = 2.0
+_gapless_length_tolerance = 2.0
+# The encoder of the current track stays this far behind the capture, a gapless cut point (which is in the past,
+# by the position of the new track plus the handling delay) can still be honoured then
+_gapless_holdback = _gapless_position_tolerance + _signal_coalesce_ms / 1000 + 0.5
+# Audio played up to this long before it reaches the capture buffer
+_capture_latency = 0.1
+_post_processing_queue_size = 16
+_post_processing_retry_ms = 200  # The main loop does not wait for a full queue, it retries the job after this time
+_post_processing_niceness = 10
+_mover_retry_seconds = 10.0  # How often the free space is checked again while the output directory is full
+_cover_cache_memory_entries = 16
+_flac_cover_art_padding = 262144  # Reserved at record time, so the cover art can be added in place
+_http_connect_timeout = 5.0
+_http_read_timeout = 15.0
+_http_retries = 3
+_http_retry_backoff = 0.5  # Waits 0.5 s, 1 s, 2 s, ... between the retries
+_control_max_request_bytes = 65536
+_job_history_size = 100
 
 # Variables that change during runtime
-is_script_paused = False
-is_first_playing = True
-pa_spotify_sink_input_id = -1
-internal_track_counter = 1
 is_shutting_down = False
+_verify = False
+_filename_template = None
+_sessions = []
 
 
 def main():
     handle_command_line()
 
+    # "spotrec verify" checks the recordings instead of recording
+    if _verify:
+        init_log()
+        sys.exit(Verifier.run(_output_directory))
+
     if not _skip_intro:
         print(app_name + " v" + app_version)
         print("You should not pause, seek or change volume during recording!")
-        print("Existing files will be overridden!")
+        print("Existing files are kept, new recordings get a -1, -2, ... suffix then.")
         print("Use --help as argument to see all options.")
         print()
         print("Disclaimer:")
@@ -82,22 +197,69 @@ def main():
 
     init_log()
 
+    if _trim_silence and numpy is None:
+        log.error(
+            "Error: The 'numpy' python module is needed to trim silence.")
+        sys.exit(1)
+
+    if _adaptive_timing and not _continuous_capture:
+        FFmpeg.check_stats_period()
+
     # Create the output directory
     Path(_output_directory).mkdir(
         parents=True, exist_ok=True)
 
-    # Init Spotify DBus listener
-    global _spotify
-    _spotify = Spotify()
+    # Take commands and jobs on the control socket (if enabled)
+    # Bound before anything is started (workers, mover, sinks), it exits if another daemon is running.
+    # Commands are handled once the event loop runs.
+    if _daemon:
+        ControlSocket.serve(_control_socket)
+
+    # Load the index of the already recorded tracks
+    if _skip_recorded:
+        RecordingIndex.load()
+
+    # Init cover art cache (before Spotify, it already prefetches the cover of the current track)
+    if _add_cover_art:
+        CoverArtCache.init()
 
-    # Load PulseAudio sink
-    PulseAudio.load_sink()
+    # Start the background workers for post-processing
+    PostProcessing.start()
 
-    _spotify.init_pa_stuff_if_needed()
+    # Start moving the finished files from the staging directory (if enabled)
+    if _staging_directory is not None:
+        Mover.start()
 
-    # Keep the main thread alive (to be able to handle KeyboardInterrupt)
-    while True:
-        time.sleep(1)
+    # Serve the metrics (if enabled)
+    if _metrics_port is not None:
+        Metrics.serve(_metrics_port)
+
+    # Connect to the PulseAudio server (if the native client is used)
+    if _native_pulse:
+        PulseAudio.connect()
+
+    # One session per player, every session has its own sink and output directory
+    for i, player in enumerate(_players):
+        if len(_players) == 1:
+            session = Session(player, _pa_recording_sink_name,
+                              _output_directory)
+        else:
+            session = Session(player, _pa_recording_sink_name + str(i + 1),
+                              os.path.join(_output_directory, player.rsplit(".", 1)[-1]))
+        _sessions.append(session)
+
+    # Connect to every player first, so a missing one exits before any sink is loaded
+    for session in _sessions:
+        session.connect()
+
+    for session in _sessions:
+        session.start()
+
+    for session in _sessions:
+        session.spotify.init_pa_stuff_if_needed()
+
+    # Process DBus signals, timers and process lifecycles in the main thread until doExit()
+    DBusListener.run()
 
 
 def doExit():
@@ -107,13 +269,27 @@ def doExit():
     is_shutting_down = True
 
     # Stop Spotify DBus listener
-    _spotify.quit_glib_loop()
+    DBusListener.quit()
+
+    # Remove the control socket (if the daemon mode is enabled)
+    ControlSocket.close()
 
-    # Kill all FFmpeg subprocesses
-    FFmpeg.killAll()
+    # Stop the recordings and unload the sinks
+    for session in _sessions:
+        session.stop()
 
-    # Unload PulseAudio sink
-    PulseAudio.unload_sink()
+    # Finish the post-processing of the already recorded tracks
+    PostProcessing.stop()
+
+    # Move the finished files into the output directory
+    Mover.stop()
+
+    Http.log_metrics()
+
+    TimingController.log_summary()
+
+    # Disconnect from the PulseAudio server (if the native client is used)
+    PulseAudio.disconnect()
 
     log.info(f"[{app_name}] Bye")
 
@@ -129,11 +305,42 @@ def handle_command_line():
     global _output_directory
     global _filename_pattern
     global _underscored_filenames
+    global _filename_charset
+    global _filename_template
     global _use_internal_track_counter
     global _add_cover_art
+    global _continuous_capture
+    global _capture_backend
+    global _gapless
+    global _native_pulse
+    global _post_processing_workers
+    global _cover_cache_directory
+    global _cover_cache_size
+    global _output_format
+    global _flac_compression_level
+    global _bitrate
+    global _transcode_format
+    global _adaptive_timing
+    global _ffmpeg_stop_timeout
+    global _trim_silence
+    global _silence_threshold
+    global _skip_recorded
+    global _metrics_file
+    global _metrics_port
+    global _players
+    global _daemon
+    global _control_socket
+    global _staging_directory
+    global _min_free_space
+
+    if len(sys.argv) > 1 and sys.argv[1] == "verify":
+        handle_verify_command_line(sys.argv[2:])
+        return
 
     parser = argparse.ArgumentParser(
-        description=app_name + " v" + app_version, formatter_class=argparse.RawTextHelpFormatter)
+        description=app_name + " v" + app_version, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="Subcommands:\n"
+               "  verify  Check the recordings in the output directory and add ReplayGain tags (see \"verify --help\")")
     parser.add_argument("-d", "--debug", help="Print a little more",
                         action="store_true", default=_debug_logging)
     parser.add_argument("-s", "--skip-intro", help="Skip the intro message",
@@ -149,10 +356,83 @@ def handle_command_line():
                                                          "Example: \"{artist}/{album}/{trackNumber} {title}\"", default=_filename_pattern)
     parser.add_argument("-u", "--underscored-filenames", help="Force the file names to have underscores instead of whitespaces",
                         action="store_true", default=_underscored_filenames)
+    parser.add_argument("--filename-charset", help="Which characters from Spotify are replaced in the file names\n"
+                                                   "posix: only \"/\", fat: also the ones FAT/exFAT/NTFS don't allow\n"
+                                                   "Default: " + _filename_charset,
+                        choices=_filename_charsets, default=_filename_charset)
     parser.add_argument("-c", "--internal-track-counter", help="Replace Spotify's trackNumber with own counter. Useable for preserving a playlist file order",
                         action="store_true", default=_use_internal_track_counter)
     parser.add_argument("-a", "--add-cover-art", help="Embed the cover art from Spotify into the file",
                         action="store_true", default=_add_cover_art)
+    parser.add_argument("--continuous-capture", help="Capture with one long-running process and split the tracks in SpotRec\n"
+                                                     "instead of starting a new FFmpeg process for every track",
+                        action="store_true", default=_continuous_capture)
+    parser.add_argument("--capture-backend", help="What reads the audio of the sink for --continuous-capture\n"
+                                                  "parec: raw PCM from parec (also works with pipewire-pulse)\n"
+                                                  "ffmpeg: FFmpeg recording with its pulse input\n"
+                                                  "Default: " + _capture_backend,
+                        choices=["parec", "ffmpeg"], default=_capture_backend)
+    parser.add_argument("-g", "--gapless", help="Record the tracks back to back without seeking to the beginning of every track\n"
+                                               "Falls back to seeking if a track boundary can't be trusted. Implies --continuous-capture",
+                        action="store_true", default=_gapless)
+    parser.add_argument("--native-pulse", help="Talk to the PulseAudio/PipeWire server directly instead of running pactl\n"
+                                               "Requires the 'pulsectl' python module",
+                        action="store_true", default=_native_pulse)
+    parser.add_argument("--post-processing-workers", help="Number of background workers for post-processing (e.g. adding cover art)\n"
+                                                          "Default: " + str(_post_processing_workers),
+                        type=int, default=_post_processing_workers)
+    parser.add_argument("--cover-cache-directory", help="Where to cache the downloaded cover art\n"
+                                                        "Default: " + _cover_cache_directory, default=_cover_cache_directory)
+    parser.add_argument("--cover-cache-size", help="Maximum size of the cover art cache in MiB\n"
+                                                   "Default: " + str(_cover_cache_size),
+                        type=int, default=_cover_cache_size)
+    parser.add_argument("-f", "--format", help="Format of the recordings: " + ", ".join(_output_profiles) + "\n"
+                                               "Default: " + _output_format,
+                        choices=_output_profiles, default=_output_format)
+    parser.add_argument("--flac-compression-level", help="FLAC compression level (0-12), 0 needs the least CPU while recording\n"
+                                                         "Default: " + str(_flac_compression_level),
+                        type=int, default=_flac_compression_level)
+    parser.add_argument("--bitrate", help="Bitrate for the lossy formats\n"
+                                          "Default: " + _bitrate, default=_bitrate)
+    parser.add_argument("--transcode", help="Transcode the finished recordings to this format in the background\n"
+                                            "(e.g. record with \"-f flac --flac-compression-level 0\" and transcode to opus)",
+                        choices=_output_profiles, default=_transcode_format)
+    parser.add_argument("--adaptive-timing", help="Measure FFmpeg startup and DBus round-trip times and adapt the waiting times to them",
+                        action="store_true", default=_adaptive_timing)
+    parser.add_argument("--stop-timeout", help="Seconds FFmpeg gets to finish a recording after it was asked to stop,\n"
+                                               "before it is terminated (and after the same time again killed)\n"
+                                               "Default: " + str(_ffmpeg_stop_timeout),
+                        type=float, default=_ffmpeg_stop_timeout)
+    parser.add_argument("-t", "--trim-silence", help="Trim silence and the overhead of the next track from the recordings\n"
+                                                     "and warn about tracks with another length than reported by Spotify\n"
+                                                     "Requires the 'numpy' python module",
+                        action="store_true", default=_trim_silence)
+    parser.add_argument("--silence-threshold", help="Audio below this level (dBFS) counts as silence\n"
+                                                    "Default: " + str(_silence_threshold),
+                        type=float, default=_silence_threshold)
+    parser.add_argument("-r", "--skip-recorded", help="Keep an index of the recorded tracks in the output directory\n"
+                                                      "and skip tracks which were already recorded (to resume a run)",
+                        action="store_true", default=_skip_recorded)
+    parser.add_argument("--metrics-file", help="Append per-track metrics as JSON lines to this file",
+                        default=_metrics_file)
+    parser.add_argument("--metrics-port", help="Serve metrics in the Prometheus text format on localhost on this port",
+                        type=int, default=_metrics_port)
+    parser.add_argument("--player", help="MPRIS bus name of a player to record, can be given multiple times\n"
+                                         "to record several players in parallel (each gets its own sink and sub directory)\n"
+                                         "Example: --player org.mpris.MediaPlayer2.spotify.instance1234\n"
+                                         "Default: " + Spotify.dbus_dest,
+                        action="append", dest="players", default=_players)
+    parser.add_argument("--staging-directory", help="Record and post-process in this directory (e.g. a tmpfs or local SSD)\n"
+                                                    "and move the finished files to the output directory in the background",
+                        default=_staging_directory)
+    parser.add_argument("--min-free-space", help="Pause recording while the output directory has less free space (in MiB)\n"
+                                                 "(with --staging-directory) Default: " + str(_min_free_space),
+                        type=int, default=_min_free_space)
+    parser.add_argument("--daemon", help="Keep running when an album or playlist ended and take commands\n"
+                                         "(status, queue of spotify: URIs, start, stop) as JSON on a control socket",
+                        action="store_true", default=_daemon)
+    parser.add_argument("--control-socket", help="Path of the control socket for --daemon\n"
+                                                 "Default: " + _control_socket, default=_control_socket)
 
     args = parser.parse_args()
 
@@ -168,10 +448,107 @@ def handle_command_line():
 
     _underscored_filenames = args.underscored_filenames
 
+    _filename_charset = args.filename_charset
+
+    try:
+        _filename_template = FilenameTemplate(
+            _filename_pattern, _underscored_filenames, _filename_charset)
+    except ValueError as e:
+        parser.error(str(e))
+
     _use_internal_track_counter = args.internal_track_counter
 
     _add_cover_art = args.add_cover_art
 
+    _gapless = args.gapless
+
+    _continuous_capture = args.continuous_capture or _gapless
+
+    _capture_backend = args.capture_backend
+
+    _native_pulse = args.native_pulse
+
+    _post_processing_workers = max(1, args.post_processing_workers)
+
+    _cover_cache_directory = args.cover_cache_directory
+
+    _cover_cache_size = args.cover_cache_size
+
+    _output_format = args.format
+
+    _flac_compression_level = args.flac_compression_level
+
+    _bitrate = args.bitrate
+
+    _transcode_format = args.transcode
+
+    _adaptive_timing = args.adaptive_timing
+
+    _ffmpeg_stop_timeout = args.stop_timeout
+
+    _trim_silence = args.trim_silence
+
+    _silence_threshold = args.silence_threshold
+
+    _skip_recorded = args.skip_recorded
+
+    _metrics_file = args.metrics_file
+
+    _metrics_port = args.metrics_port
+
+    _players = args.players or [Spotify.dbus_dest]
+
+    _staging_directory = args.staging_directory
+
+    _min_free_space = args.min_free_space
+
+    _daemon = args.daemon
+
+    _control_socket = args.control_socket
+
+
+def handle_verify_command_line(argv):
+    global _verify
+    global _debug_logging
+    global _output_directory
+    global _verify_processes
+    global _replaygain_tags
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + " verify",
+        description="Check that the recordings decode completely (FLAC: frame CRCs, MD5 and sample count of STREAMINFO),\n"
+                    "measure their EBU R128 loudness and true peak and write ReplayGain tags into the FLAC files.\n"
+                    "Files which did not change since the last run are not checked again.",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-d", "--debug", help="Print a little more",
+                        action="store_true", default=_debug_logging)
+    parser.add_argument("-o", "--output-directory", help="The recordings to check\n"
+                                                         "Default: " + _output_directory, default=_output_directory)
+    parser.add_argument("-j", "--processes", help="Number of files checked in parallel\n"
+                                                  "Default: " + str(_verify_processes),
+                        type=int, default=_verify_processes)
+    parser.add_argument("--no-replaygain", help="Do not write ReplayGain tags",
+                        action="store_true", default=not _replaygain_tags)
+
+    args = parser.parse_args(argv)
+
+    _verify = True
+
+    _debug_logging = args.debug
+
+    _output_directory = args.output_directory
+
+    _verify_processes = max(1, args.processes)
+
+    _replaygain_tags = not args.no_replaygain
+
+
+# Nearest-rank percentile of a non-empty list
+def percentile(values, p):
+    ordered = sorted(values)
+    index = max(0, -(-len(ordered) * p // 100) - 1)
+    return ordered[int(index)]
+
 
 def init_log():
     global log
@@ -189,13 +566,233 @@ def init_log():
     log.debug("Logger initialized")
 
 
+# One recording session: a player on the session bus with its own sink, capture pipeline and output directory
+class Session:
+    def __init__(self, dbus_dest: str, sink_name: str, output_directory: str):
+        self.dbus_dest = dbus_dest
+        self.sink_name = sink_name
+        self.output_directory = output_directory
+        # Where the tracks are recorded and post-processed, the same place in the staging directory (if enabled)
+        if _staging_directory is not None:
+            self.record_directory = os.path.normpath(os.path.join(
+                _staging_directory, os.path.relpath(output_directory, _output_directory)))
+        else:
+            self.record_directory = output_directory
+        self.sink_id = ""
+        self.spotify = None
+        self.spotify_pid = None
+        self.spotify_sink_input_id = -1
+        self.is_first_playing = True
+        self.is_script_paused = False
+        self.internal_track_counter = 1
+        self.ffmpeg_instances = []
+        self.capture = None
+        self.watcher = None
+        self.stopped = False
+        # The job of the daemon mode which is played in this session
+        self.job = None
+        # Set while the recording is paused because the output directory is full
+        self.paused_by_mover = False
+
+    # Connect to the player (exits if it is not running), nothing is loaded or started yet
+    def connect(self):
+        # Create the output directory
+        Path(self.output_directory).mkdir(
+            parents=True, exist_ok=True)
+        Path(self.record_directory).mkdir(
+            parents=True, exist_ok=True)
+
+        self.spotify = Spotify(self)
+
+    def start(self):
+        # Load PulseAudio sink
+        PulseAudio.load_sink(self)
+
+        # Keep Spotify routed to the sink
+        PulseAudio.start_watcher(self)
+
+        # Start the long-running capture process (if enabled)
+        if _continuous_capture:
+            self.capture = ContinuousCapture(self)
+            self.capture.start()
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+
+        self.spotify.log_dbus_cmd_timings()
+
+        # Stop the long-running capture process and its encoders
+        if self.capture is not None:
+            self.capture.stop()
+
+        # Kill all FFmpeg subprocesses
+        FFmpeg.killAll(self)
+
+        # Unload PulseAudio sink
+        PulseAudio.unload_sink(self)
+
+    # Called when the album or playlist of this session ended
+    def finish(self):
+        # The daemon keeps the session and its sink for the next job
+        if _daemon:
+            JobQueue.session_finished(self)
+            return
+
+        if all(session is self or session.stopped for session in _sessions):
+            doExit()
+            return
+
+        log.info(f"[{app_name}] Session {self.dbus_dest} finished")
+        self.stop()
+
+
+# Runs the GLib event loop (shared by all sessions) in the main thread
+# DBus signals, the steps of a recording and the stopping of FFmpeg processes are all handled in this loop,
+# so they run one after another and a pending step can be cancelled when the track changes again
+class DBusListener:
+    glibloop = None
+
+    @staticmethod
+    def run():
+        DBusListener.glibloop = GLib.MainLoop()
+
+        # Handle Ctrl^C and SIGTERM in the loop (not print error when pressing Ctrl^C)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, DBusListener.on_signal)
+
+        log.info(f"[{app_name}] Spotify DBus listener started")
+        DBusListener.glibloop.run()
+
+    @staticmethod
+    def on_signal():
+        doExit()
+        return False
+
+    @staticmethod
+    def quit():
+        if DBusListener.glibloop is not None:
+            DBusListener.glibloop.quit()
+
+        log.info(f"[{app_name}] Spotify DBus listener stopped")
+
+
+# The filename pattern, checked once
+# Renders the track path (relative to the output directory) from the metadata, safe for the file system:
+# it costs a few microseconds more than a plain str.format() per track change (see benchmark/filenames.py)
+class FilenameTemplate:
+    fields = ("artist", "album", "trackNumber", "title")
+
+    # Used for --underscored-filenames
+    underscore_separator = re.compile(" - ")
+    underscore_chars = re.compile(r"[\s\-\[\]()']+")
+    underscore_repeated = re.compile("__+")
+
+    def __init__(self, pattern: str, underscored: bool, charset: str):
+        if underscored:
+            pattern = FilenameTemplate.underscore_separator.sub("__", pattern)
+        self.underscored = underscored
+        self.fat = charset == "fat"
+
+        # Check the pattern once here, so that rendering can not fail later
+        self.pattern = pattern
+        try:
+            for _, field, _, _ in string.Formatter().parse(pattern):
+                if field is not None and field not in FilenameTemplate.fields:
+                    raise ValueError(
+                        f"unknown field {{{field}}}, available: " + ", ".join("{" + f + "}" for f in FilenameTemplate.fields))
+        except ValueError as e:
+            raise ValueError(f"Invalid filename pattern: {e}")
+
+        self.replacements = {chr(c): "" for c in range(32)}
+        self.replacements["\x7f"] = ""
+        self.replacements.update(_filename_charsets[charset])
+        # A regex is much faster than str.translate() on non-ASCII text, most values have nothing to replace
+        # (checked with one search over all values)
+        self.unsafe = re.compile("[\\x00-\\x1f\\x7f" + re.escape("".join(_filename_charsets[charset])) + "]")
+        # Only patterns with slashes create directories (the slashes in the values are always replaced)
+        self.directories = "/" in pattern
+
+    def render(self, values: dict):
+        artist = str(values["artist"] or "")
+        album = str(values["album"] or "")
+        trackNumber = str(values["trackNumber"] or "")
+        title = str(values["title"] or "")
+        if self.unsafe.search(artist + album + trackNumber + title):
+            artist = self.unsafe.sub(self.replace, artist)
+            album = self.unsafe.sub(self.replace, album)
+            trackNumber = self.unsafe.sub(self.replace, trackNumber)
+            title = self.unsafe.sub(self.replace, title)
+
+        text = self.pattern.format(artist=artist, album=album, trackNumber=trackNumber, title=title)
+
+        if self.underscored:
+            text = text.replace(".", "").lower()
+            text = FilenameTemplate.underscore_chars.sub("_", text)
+            text = FilenameTemplate.underscore_repeated.sub("__", text)
+
+        if self.directories:
+            return "/".join(self.clean_component(component)
+                            for component in text.split("/"))
+        return self.clean_component(text)
+
+    def replace(self, match):
+        return self.replacements[match.group()]
+
+    def clean_component(self, component: str):
+        if self.fat:
+            component = component.rstrip(" .")
+        component = FilenameTemplate.truncate(component, _filename_max_bytes)
+        if component in ("", ".", ".."):
+            return "_"
+        return component
+
+    # Cut to a maximum length in bytes (file systems limit bytes, not characters), without splitting a character
+    @staticmethod
+    def truncate(text: str, max_bytes: int):
+        # A character has at most 4 bytes in UTF-8, short names don't have to be encoded
+        if len(text) * 4 <= max_bytes:
+            return text
+        encoded = text.encode("utf-8")
+        if len(encoded) <= max_bytes:
+            return text
+        return encoded[:max_bytes].decode("utf-8", errors="ignore")
+
+    # Returns the path or, if it exists, the first free one with a "-1", "-2", ... suffix
+    @staticmethod
+    def unique_path(path: str):
+        if not os.path.exists(path):
+            return path
+        base, ext = os.path.splitext(path)
+        counter = 1
+        while os.path.exists(f"{base}-{counter}{ext}"):
+            counter += 1
+        return f"{base}-{counter}{ext}"
+
+
 class Spotify:
     dbus_dest = "org.mpris.MediaPlayer2.spotify"
     dbus_path = "/org/mpris/MediaPlayer2"
     mpris_player_string = "org.mpris.MediaPlayer2.Player"
 
-    def __init__(self):
-        self.glibloop = None
+    def __init__(self, session: Session):
+        self.session = session
+        self.dbus_dest = session.dbus_dest
+        self.dbus_cmd_timings = {}
+        # GLib source id of the next step of a pending recording
+        self.record_timer = None
+        # FFmpeg instance of a pending recording which is waiting for the track to be played
+        self.record_ff = None
+        # FFmpeg instance of the track which is played now (the recording before may still run for its after-song time)
+        self.current_ff = None
+
+        # PropertiesChanged signals which were not handled yet (see on_playing_uri_changed())
+        self.coalesce_timer = None
+        self.pending_changes = {}
+        self.pending_invalidated = set()
+        self.pending_signals = 0
+        self.trackid_signal_time = 0
 
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
@@ -205,6 +802,13 @@ class Spotify:
             player = bus.get_object(self.dbus_dest, self.dbus_path)
             self.iface = dbus.Interface(
                 player, "org.freedesktop.DBus.Properties")
+            self.player = dbus.Interface(
+                player, self.mpris_player_string)
+            # The process id is needed to find the stream of this player if several are recorded
+            dbus_iface = dbus.Interface(bus.get_object(
+                "org.freedesktop.DBus", "/org/freedesktop/DBus"), "org.freedesktop.DBus")
+            session.spotify_pid = int(
+                dbus_iface.GetConnectionUnixProcessID(self.dbus_dest))
             # Pull the metadata of the current track from Spotify
             self.pull_metadata()
             # Update own metadata vars for current track
@@ -215,45 +819,48 @@ class Spotify:
             sys.exit(1)
             pass
 
-        self.track = self.get_track()
         self.trackid = self.metadata.get(dbus.String(u'mpris:trackid'))
+        self.track = self.get_track()
         self.playbackstatus = self.iface.Get(
             self.mpris_player_string, "PlaybackStatus")
 
         self.iface.connect_to_signal(
             "PropertiesChanged", self.on_playing_uri_changed)
+        self.player.connect_to_signal(
+            "Seeked", self.on_seeked)
 
-        class DBusListenerThread(Thread):
-            def __init__(self, parent, *args):
-                Thread.__init__(self)
-                self.parent = parent
-
-            def run(self):
-                # Run the GLib event loop to process DBus signals as they arrive
-                self.parent.glibloop = GLib.MainLoop()
-                self.parent.glibloop.run()
-
-                # run() blocks this thread. This gets printed after it's dead.
-                log.info(f"[{app_name}] GLib Loop thread killed")
-
-        dbuslistener = DBusListenerThread(self)
-        dbuslistener.start()
-
-        log.info(f"[{app_name}] Spotify DBus listener started")
+        # Time when the last track change signal arrived and when SpotRec sent the last command
+        self.trackid_changed_time = time.monotonic()
+        self.last_cmd_time = 0
 
+        log.info(f"[{app_name}] Connected to {self.dbus_dest}")
         log.info(f"[{app_name}] Current song: {self.track}")
         log.info(f"[{app_name}] Current state: " + self.playbackstatus)
 
-    # TODO: this is a dirty solution (uses cmdline instead of python for now)
-    def send_dbus_cmd(self, cmd):
-        Shell.run('dbus-send --print-reply --dest=' + self.dbus_dest +
-                  ' ' + self.dbus_path + ' ' + self.mpris_player_string + '.' + cmd)
-
-    def quit_glib_loop(self):
-        if self.glibloop is not None:
-            self.glibloop.quit()
+    # Returns False if Spotify did not accept the command
+    def send_dbus_cmd(self, cmd, *args):
+        self.last_cmd_time = time.monotonic()
 
-        log.info(f"[{app_name}] Spotify DBus listener stopped")
+        # The call blocks until Spotify acknowledged the command
+        start = time.perf_counter()
+        try:
+            getattr(self.player, cmd)(*args)
+        except DBusException as e:
+            log.warning(f"[Spotify] {cmd} failed: {e}")
+            return False
+        duration = time.perf_counter() - start
+
+        self.dbus_cmd_timings.setdefault(cmd, []).append(duration)
+        TimingController.add_sample("dbus", duration)
+        log.debug(f"[Spotify] {cmd} acknowledged after {duration * 1000:.1f} ms")
+        return True
+
+    def log_dbus_cmd_timings(self):
+        for cmd, timings in self.dbus_cmd_timings.items():
+            log.info(f"[Spotify] {cmd}: {len(timings)} calls, "
+                     f"median {percentile(timings, 50) * 1000:.1f} ms, "
+                     f"p95 {percentile(timings, 95) * 1000:.1f} ms, "
+                     f"max {max(timings) * 1000:.1f} ms")
 
     def get_metadata_for_ffmpeg(self):
         return {
@@ -262,150 +869,312 @@ class Spotify:
             "track": self.metadata_trackNumber.lstrip("0"),
             "title": self.metadata_title,
             "cover_url": self.metadata_artUrl,
+            "length": self.metadata_length,
+            "trackid": self.trackid,
+            "signal_time": self.trackid_changed_time,
         }
 
     def get_track(self):
-        if _underscored_filenames:
-            filename_pattern = re.sub(" - ", "__", _filename_pattern)
-        else:
-            filename_pattern = _filename_pattern
-
-        ret = str(filename_pattern.format(
-            artist=self.metadata_artist.replace("/", "_"),
-            album=self.metadata_album.replace("/", "_"),
-            trackNumber=self.metadata_trackNumber,
-            title=self.metadata_title.replace("/", "_")
-        ))
-
-        if _underscored_filenames:
-            ret = ret.replace(".", "").lower()
-            ret = re.sub(r"[\s\-\[\]()']+", "_", ret)
-            ret = re.sub("__+", "__", ret)
-
-        return ret
+        return _filename_template.render({
+            "artist": self.metadata_artist,
+            "album": self.metadata_album,
+            "trackNumber": self.metadata_trackNumber,
+            "title": self.metadata_title,
+        })
 
     def is_playing(self):
         return self.playbackstatus == "Playing"
 
+    # Runs the steps of a recording as timers in the event loop
+    # Only one recording can be pending per player, a track change cancels the steps of the track before
     def start_record(self):
-        # Start new recording in new Thread
-        class RecordThread(Thread):
-            def __init__(self, parent, *args):
-                Thread.__init__(self)
-                self.parent = parent
+        session = self.session
 
-            def run(self):
-                global is_script_paused
-                global _output_directory
+        self.cancel_record()
 
-                # Save current trackid to check later if it is still the same song playing (to avoid a bug when user skipped a song)
-                self.trackid_when_thread_started = self.parent.trackid
+        # Stop the recording before
+        # Use copy() to not change the list during this method runs
+        self.stop_old_recording(session.ffmpeg_instances.copy())
+        self.current_ff = None
 
-                # Stop the recording before
-                # Use copy() to not change the list during this method runs
-                self.parent.stop_old_recording(FFmpeg.instances.copy())
+        # Skip tracks which were already recorded (without waiting for the seek)
+        if self.skip_if_recorded():
+            return
 
-                # This is currently the only way to seek to the beginning (let it Play for some seconds, Pause and send Previous)
-                time.sleep(_playback_time_before_seeking_to_beginning)
+        # This is currently the only way to seek to the beginning (let it Play for some seconds, Pause and send Previous)
+        self.schedule_record_step(TimingController.playback_time_before_seeking_to_beginning(),
+                                  self.seek_to_beginning, time.monotonic())
 
-                # Check if still the same song is still playing, return if not
-                if self.trackid_when_thread_started != self.parent.trackid:
-                    return
+    def schedule_record_step(self, delay: float, step, *args):
+        def run_step():
+            self.record_timer = None
+            step(*args)
+            return False
 
-                # Spotify pauses when the playlist ended. Don't start a recording / return in this case.
-                if not self.parent.is_playing():
-                    log.info(
-                        f"[{app_name}] Spotify is paused. Maybe the current album or playlist has ended.")
+        self.record_timer = GLib.timeout_add(int(delay * 1000), run_step)
 
-                    # Exit after playlist recorded
-                    if not is_script_paused:
-                        doExit()
+    def cancel_record(self):
+        if self.record_timer is not None:
+            GLib.source_remove(self.record_timer)
+            self.record_timer = None
+            log.debug(f"[{app_name}] Cancelled the pending recording")
 
-                    return
+        # The track of a started FFmpeg recording was not played, its file is of no use
+        if self.record_ff is not None:
+            self.record_ff.abort()
+            self.record_ff = None
 
-                # Do not record ads
-                if self.parent.trackid.startswith("spotify:ad:"):
-                    log.debug(f"[{app_name}] Skipping ad")
-                    return
+    def seek_to_beginning(self, seek_start: float):
+        session = self.session
+
+        # Spotify pauses when the playlist ended. Don't start a recording / return in this case.
+        if not self.is_playing():
+            log.info(
+                f"[{app_name}] Spotify is paused. Maybe the current album or playlist has ended.")
+
+            # Exit after playlist recorded
+            if not session.is_script_paused:
+                session.finish()
+
+            return
+
+        # Do not record ads
+        if self.trackid.startswith("spotify:ad:"):
+            log.debug(f"[{app_name}] Skipping ad")
+            return
 
-                log.info(f"[{app_name}] Starting recording")
+        log.info(f"[{app_name}] Starting recording")
+
+        # Set is_script_paused to not trigger wrong Pause event in playbackstatus_changed()
+        session.is_script_paused = True
+        # Pause until out dir is created
+        self.send_dbus_cmd("Pause")
+        # Audio before this position belongs to the middle of the track
+        if _continuous_capture:
+            pause_pos = session.capture.position_at(
+                time.monotonic() + _capture_latency)
+
+        # Create output folder if necessary
+        # If filename_pattern specifies subfolder(s) the track name is only the basename while the dirname is the subfolder path
+        out_dir = os.path.join(
+            session.record_directory, os.path.dirname(self.track))
+        Path(out_dir).mkdir(
+            parents=True, exist_ok=True)
+
+        # Go to beginning of the song
+        session.is_script_paused = False
+        self.send_dbus_cmd("Previous")
+
+        if _continuous_capture:
+            # Mark the cut point in the running capture (no startup time needed)
+            ff = session.capture.start_track(out_dir,
+                                             self.track, self.get_metadata_for_ffmpeg(), min_start_pos=pause_pos)
+            self.play_recorded_track(ff, seek_start)
+        else:
+            # Start FFmpeg recording
+            ff = FFmpeg(session)
+            ff.record(out_dir,
+                      self.track, self.get_metadata_for_ffmpeg())
+            self.record_ff = ff
 
-                # Set is_script_paused to not trigger wrong Pause event in playbackstatus_changed()
-                is_script_paused = True
-                # Pause until out dir is created
-                self.parent.send_dbus_cmd("Pause")
+            # Give FFmpeg some time to start up before starting the song
+            self.schedule_record_step(TimingController.recording_time_before_song(),
+                                      self.play_recorded_track, ff, seek_start)
 
-                # Create output folder if necessary
-                # If filename_pattern specifies subfolder(s) the track name is only the basename while the dirname is the subfolder path
-                self.out_dir = os.path.join(
-                    _output_directory, os.path.dirname(self.parent.track))
-                Path(self.out_dir).mkdir(
-                    parents=True, exist_ok=True)
+    def play_recorded_track(self, ff, seek_start: float):
+        self.record_ff = None
+        self.current_ff = ff
 
-                # Go to beginning of the song
-                is_script_paused = False
-                self.parent.send_dbus_cmd("Previous")
+        # Play the track
+        self.send_dbus_cmd("Play")
 
-                # Start FFmpeg recording
-                ff = FFmpeg()
-                ff.record(self.out_dir,
-                          self.parent.track, self.parent.get_metadata_for_ffmpeg())
+        ff.metrics["seek_time"] = round(
+            time.monotonic() - seek_start, 3)
 
-                # Give FFmpeg some time to start up before starting the song
-                time.sleep(_recording_time_before_song)
+    # Pause and discard the recording of the current track (the stop command of the daemon mode)
+    def stop_recording(self):
+        self.cancel_record()
 
-                # Play the track
-                self.parent.send_dbus_cmd("Play")
+        # Like a pause by SpotRec, the session is not finished by it
+        self.session.is_script_paused = True
+        self.send_dbus_cmd("Pause")
 
-        record_thread = RecordThread(self)
-        record_thread.start()
+        # Only the current track is discarded, the recording before is finished by stop_old_recording()
+        if self.session.capture is not None:
+            self.session.capture.abort_track()
+        elif self.current_ff is not None:
+            self.current_ff.abort()
+        self.current_ff = None
 
     def stop_old_recording(self, instances):
+        if _continuous_capture:
+            # Set the cut point of the track before, the capture keeps running
+            if self.session.capture is not None:
+                self.session.capture.end_track()
+            return
+
         # Stop the oldest FFmpeg instance (from recording of song before) (if one is running)
+        # Record a little longer to not miss something
         if len(instances) > 0:
-            class OverheadRecordingStopThread(Thread):
-                def run(self):
-                    # Record a little longer to not miss something
-                    time.sleep(_recording_time_after_song)
-
-                    # Stop the recording
-                    instances[0].stop_blocking()
+            def stop_overhead_recording():
+                instances[0].stop()
+                return False
 
-            overhead_recording_stop_thread = OverheadRecordingStopThread()
-            overhead_recording_stop_thread.start()
+            GLib.timeout_add(int(TimingController.recording_time_after_song() * 1000),
+                             stop_overhead_recording)
 
-    # This gets called whenever Spotify sends the playingUriChanged signal
-    def on_playing_uri_changed(self, Player, three, four):
-        # Pull updated metadata from Spotify
-        self.pull_metadata()
-
-        # Update track & trackid
-        new_trackid = self.metadata.get(dbus.String(u'mpris:trackid'))
-        if self.trackid != new_trackid:
-            # Update internal track metadata vars
-            self.update_metadata()
-            # Update trackid
-            self.trackid = new_trackid
-            # Update track name
-            self.track = self.get_track()
-            # Trigger event method
-            self.playing_song_changed()
-            # Update track counter
-            if _use_internal_track_counter:
-                global internal_track_counter
-                internal_track_counter += 1
-
-        # Update playback status
-        new_playbackstatus = self.iface.Get(Player, "PlaybackStatus")
-        if self.playbackstatus != new_playbackstatus:
+    # This gets called whenever Spotify sends the PropertiesChanged signal
+    # The changed values are taken from the signal, a burst of signals is collected and handled once
+    def on_playing_uri_changed(self, interface, changed, invalidated):
+        if interface != self.mpris_player_string:
+            return
+        signal_time = time.monotonic()
+
+        if self.coalesce_timer is None:
+            self.coalesce_timer = GLib.timeout_add(
+                _signal_coalesce_ms, self.apply_property_changes)
+            self.trackid_signal_time = signal_time
+
+        # Remember when the signal with the new track arrived, not when the burst is handled
+        metadata = changed.get("Metadata")
+        if metadata is not None and metadata.get("mpris:trackid") != self.pending_trackid():
+            self.trackid_signal_time = signal_time
+
+        for name, value in changed.items():
+            self.pending_changes[str(name)] = value
+            self.pending_invalidated.discard(str(name))
+        for name in invalidated:
+            self.pending_changes.pop(str(name), None)
+            self.pending_invalidated.add(str(name))
+        self.pending_signals += 1
+
+    # The trackid after the signals which were not handled yet
+    def pending_trackid(self):
+        if "Metadata" in self.pending_changes:
+            return self.pending_changes["Metadata"].get("mpris:trackid")
+        return self.trackid
+
+    def apply_property_changes(self):
+        self.coalesce_timer = None
+        changes, self.pending_changes = self.pending_changes, {}
+        invalidated, self.pending_invalidated = self.pending_invalidated, set()
+        if self.pending_signals > 1:
+            log.debug(
+                f"[Spotify] {self.pending_signals} PropertiesChanged signals handled together")
+        self.pending_signals = 0
+
+        # Properties which were only invalidated have to be pulled
+        for name in invalidated & {"Metadata", "PlaybackStatus"}:
+            try:
+                changes[name] = self.iface.Get(self.mpris_player_string, name)
+            except DBusException as e:
+                log.warning(f"[Spotify] Get {name} failed: {e}")
+
+        # Update playback status first: at the end of a playlist Spotify sends the first track together with "Paused",
+        # the track change must see that the player is paused
+        new_playbackstatus = changes.get("PlaybackStatus")
+        if new_playbackstatus is not None and self.playbackstatus != new_playbackstatus:
             self.playbackstatus = new_playbackstatus
             self.playbackstatus_changed()
 
+        # Update track & trackid
+        if "Metadata" in changes:
+            self.metadata = changes["Metadata"]
+            new_trackid = self.metadata.get(dbus.String(u'mpris:trackid'))
+            if self.trackid != new_trackid:
+                # Update internal track metadata vars
+                self.update_metadata()
+                # Update trackid
+                self.trackid = new_trackid
+                # Update track name
+                self.track = self.get_track()
+                self.trackid_changed_time = self.trackid_signal_time
+                # Trigger event method
+                self.playing_song_changed()
+                # Update track counter
+                if _use_internal_track_counter:
+                    self.session.internal_track_counter += 1
+
+        return False
+
     def playing_song_changed(self):
         log.info("[Spotify] Song changed: " + self.track)
 
+        # The pending recording of the track before must not start anymore
+        self.cancel_record()
+
+        if _gapless and self.start_gapless_record():
+            return
+
         self.start_record()
 
+    # Cut the running capture at the track change instead of seeking to the beginning of the track
+    # Returns False if the boundary can't be trusted, the normal recording has to be used then
+    def start_gapless_record(self):
+        capture = self.session.capture
+        if capture is None or not self.is_playing():
+            return False
+
+        # Spotify reports how far it is into the new track, it has to be close to the beginning
+        position_time = time.monotonic()
+        position = self.get_position()
+        if position is None or position > _gapless_position_tolerance:
+            log.info(
+                f"[{app_name}] Track boundary not trusted (position: {position}), seeking to the beginning")
+            return False
+
+        # The position is from now, not from the time of the signal (the signals are handled a little later)
+        cut_pos = capture.position_at(
+            position_time) - capture.seconds_to_bytes(position)
+        capture.end_track(cut_pos)
+
+        # Do not record ads
+        if self.trackid.startswith("spotify:ad:"):
+            log.debug(f"[{app_name}] Skipping ad")
+            return True
+
+        if self.skip_if_recorded():
+            return True
+
+        out_dir = os.path.join(
+            self.session.record_directory, os.path.dirname(self.track))
+        Path(out_dir).mkdir(
+            parents=True, exist_ok=True)
+
+        log.info(f"[{app_name}] Starting gapless recording")
+        capture.start_track(out_dir, self.track, self.get_metadata_for_ffmpeg(),
+                            start_pos=cut_pos, expected_length=self.metadata_length)
+        return True
+
+    # Sends Next if the current track is in the index of recorded tracks
+    def skip_if_recorded(self):
+        if not _skip_recorded or not RecordingIndex.is_recorded(self.trackid):
+            return False
+
+        log.info(f"[{app_name}] Already recorded, skipping: {self.track}")
+        self.send_dbus_cmd("Next")
+        return True
+
+    # Playback position in seconds (or None if Spotify does not report it)
+    def get_position(self):
+        try:
+            return int(self.iface.Get(self.mpris_player_string, "Position")) / 1000000
+        except DBusException:
+            return None
+
+    # This gets called whenever the playback position jumps
+    def on_seeked(self, position):
+        # Ignore seeks caused by SpotRec itself (Previous)
+        if time.monotonic() - self.last_cmd_time < 1:
+            return
+
+        capture = self.session.capture
+        if _gapless and capture is not None and capture.current is not None:
+            log.info(
+                f"[{app_name}] Seek detected, recording the current track again from the beginning")
+            capture.abort_track()
+            self.start_record()
+
     def playbackstatus_changed(self):
         log.info("[Spotify] State changed: " + self.playbackstatus)
 
@@ -419,6 +1188,8 @@ class Spotify:
             self.metadata.get(dbus.String(u'xesam:artist')))
         self.metadata_album = self.metadata.get(dbus.String(u'xesam:album'))
         self.metadata_title = self.metadata.get(dbus.String(u'xesam:title'))
+        self.metadata_length = int(self.metadata.get(
+            dbus.String(u'mpris:length'), 0)) / 1000000
         self.metadata_trackNumber = str(self.metadata.get(
             dbus.String(u'xesam:trackNumber'))).zfill(2)
         # https://github.com/patrickziegler/SpotifyRecorder/blob/4c1cc0a5449d0ca8bfb409ef98f4c7a21c73fe0f/spotify_recorder/track.py#L88
@@ -429,292 +1200,2779 @@ class Spotify:
         )
 
         if _use_internal_track_counter:
-            global internal_track_counter
-            self.metadata_trackNumber = str(internal_track_counter).zfill(3)
+            self.metadata_trackNumber = str(
+                self.session.internal_track_counter).zfill(3)
+
+        # Fetch the cover art while the track is still recording
+        if _add_cover_art:
+            CoverArtCache.prefetch(self.metadata_artUrl)
 
     def init_pa_stuff_if_needed(self):
         if self.is_playing():
-            global is_first_playing
-            if is_first_playing:
-                is_first_playing = False
+            if self.session.is_first_playing:
+                self.session.is_first_playing = False
                 log.debug(f"[{app_name}] Initializing PulseAudio stuff")
 
-                PulseAudio.init_spotify_sink_input_id()
-                PulseAudio.set_sink_volumes_to_100()
+                PulseAudio.init_spotify_sink_input_id(self.session)
+                PulseAudio.set_sink_volumes_to_100(self.session)
 
-                PulseAudio.move_spotify_to_own_sink()
+                self.session.watcher.request_move()
 
 
 class FFmpeg:
-    instances = []
+    # Numbers the hidden files of the recordings
+    recording_counter = itertools.count(1)
+    # "-stats_period" is needed to measure the start of a recording, it exists since FFmpeg 4.4 (see check_stats_period())
+    supports_stats_period = False
+
+    # Older FFmpeg versions exit at startup on an unknown option, so it is checked once
+    @staticmethod
+    def check_stats_period():
+        try:
+            options = Shell.check_output(
+                [_ffmpeg_executable, "-hide_banner", "-h", "full"], c_locale=True)
+        except (OSError, subprocess.CalledProcessError):
+            options = ""
+        FFmpeg.supports_stats_period = "-stats_period" in options
+        if not FFmpeg.supports_stats_period:
+            log.warning(
+                "[FFmpeg] This FFmpeg has no -stats_period (FFmpeg 4.4 or newer is needed), "
+                "the recording start is not measured for --adaptive-timing")
+
+    def __init__(self, session: Session):
+        self.session = session
 
     def record(self, out_dir: str, file: str, metadata_for_file={}):
-        self.out_dir = out_dir
+        self.pulse_input = self.session.sink_name + ".monitor"
+
+        # FFmpeg Input Options:
+        #  "-ac 2": always use 2 audio channels (stereo) (same as Spotify)
+        #  "-ar 44100": always use 44.1k samplerate (same as Spotify)
+        #  "-fragment_size 8820": set recording latency to 50 ms (0.05*44100*2*2) (very high values can cause ffmpeg to not stop fast enough, so post-processing fails)
+        #  stdin: a pipe to send "q" to stop the recording (see request_stop())
+        self.start(out_dir, file, metadata_for_file,
+                   ['-f', 'pulse', '-ac', '2', '-ar', '44100', '-fragment_size', '8820', '-i', self.pulse_input],
+                   stdin=subprocess.PIPE, progress=_adaptive_timing and FFmpeg.supports_stats_period)
+
+        self.session.ffmpeg_instances.append(self)
+
+        log.info(f"[FFmpeg] [{self.pid}] Recording started")
+
+    # Encode raw PCM which is written to the stdin of the process (used by ContinuousCapture)
+    def encode(self, out_dir: str, file: str, metadata_for_file={}):
+        self.start(out_dir, file, metadata_for_file,
+                   ['-f', 's16le', '-ac', str(_pcm_channels), '-ar', str(_pcm_sample_rate), '-i', 'pipe:0'],
+                   stdin=subprocess.PIPE)
 
-        self.pulse_input = _pa_recording_sink_name + ".monitor"
+        log.info(f"[FFmpeg] [{self.pid}] Encoding started")
+
+    def start(self, out_dir: str, file: str, metadata_for_file, input_params, stdin=None, progress=False):
+        self.out_dir = out_dir
+        self.file = file
+        self.start_time = time.monotonic()
+        # Kept to be able to encode the track again
+        self.metadata_for_file = dict(metadata_for_file)
 
         # Use a dot as filename prefix to hide the file until the recording was successful
+        # Every recording gets its own file: the same track may be recorded again while the encoder
+        # of the last recording is still running (repeat, duplicates in a playlist)
         self.tmp_file_prefix = "."
-        self.filename = self.tmp_file_prefix + \
-            os.path.basename(file) + ".flac"
+        self.final_filename = os.path.basename(file) + "." + \
+            _output_profiles[_output_format]["extension"]
+        self.filename = os.path.basename(FilenameTemplate.unique_path(os.path.join(
+            out_dir, f"{self.tmp_file_prefix}{os.path.basename(file)}.{next(FFmpeg.recording_counter)}."
+                     f"{_output_profiles[_output_format]['extension']}")))
 
         # save this to self because metadata_params is discarded after this function
         self.cover_url = metadata_for_file.pop('cover_url')
+        self.expected_length = metadata_for_file.pop('length', 0)
+        self.trackid = metadata_for_file.pop('trackid', None)
+        self.metrics = {}
+        signal_time = metadata_for_file.pop('signal_time', None)
+        if signal_time is not None:
+            self.metrics["signal_to_record_latency"] = round(
+                self.start_time - signal_time, 3)
+        self.trim_verdict = None
+        # Set by abort(), the file is deleted instead of post-processed
+        self.discard = False
         # build metadata param
-        metadata_params = ''
+        metadata_params = []
         for key, value in metadata_for_file.items():
-            metadata_params += ' -metadata ' + key + '=' + shlex.quote(value)
+            metadata_params += ['-metadata', key + '=' + value]
 
         # FFmpeg Options:
         #  "-hide_banner": short the debug log a little
-        #  "-y": overwrite existing files
-        #  "-ac 2": always use 2 audio channels (stereo) (same as Spotify)
-        #  "-ar 44100": always use 44.1k samplerate (same as Spotify)
-        #  "-fragment_size 8820": set recording latency to 50 ms (0.05*44100*2*2) (very high values can cause ffmpeg to not stop fast enough, so post-processing fails)
-        #  "-acodec flac": use the flac lossless audio codec, so we don't lose quality while recording
-        self.process = Shell.Popen(_ffmpeg_executable + ' -hide_banner -y '
-                                   '-f pulse ' +
-                                   '-ac 2 -ar 44100 -fragment_size 8820 ' +
-                                   '-i ' + self.pulse_input + metadata_params + ' '
-                                   '-acodec flac' +
-                                   ' ' + shlex.quote(os.path.join(self.out_dir, self.filename)))
+        #  "-n": never overwrite an existing file (fail instead)
+        #  codec params: from the output profile (flac by default, so we don't lose quality while recording)
+        #  "-progress pipe:1": report the progress on stdout, used to measure when the first audio arrived
+        if progress:
+            metadata_params += ['-progress', 'pipe:1', '-stats_period', '0.05']
+        self.process = Shell.Popen([_ffmpeg_executable, '-hide_banner', '-n'] +
+                                   input_params + metadata_params +
+                                   FFmpeg.output_params(_output_format) +
+                                   [os.path.join(self.out_dir, self.filename)],
+                                   stdin=stdin, stdout=subprocess.PIPE if progress else None)
 
         self.pid = str(self.process.pid)
 
-        self.instances.append(self)
-
-        log.info(f"[FFmpeg] [{self.pid}] Recording started")
-
-    # The blocking version of this method waits until the process is dead
-    def stop_blocking(self):
-        # Remove from instances list (and terminate)
-        if self in self.instances:
-            self.instances.remove(self)
-
-            # Send CTRL_C
-            self.process.terminate()
+        if progress:
+            self.first_packet = False
+            self.progress_rest = b""
+            GLib.io_add_watch(self.process.stdout.fileno(), GLib.PRIORITY_DEFAULT,
+                              GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_progress)
+
+    # Reads the progress reports in the event loop
+    def on_progress(self, fd, condition):
+        # Has to read until the end, otherwise FFmpeg blocks when the pipe is full
+        data = os.read(fd, 4096)
+        if not data:
+            # FFmpeg exited (its output goes to /dev/null unless --debug is set)
+            if not self.first_packet and not self.discard:
+                log.warning(
+                    f"[FFmpeg] [{self.pid}] Exited before any audio was recorded, use --debug to see its output")
+            self.process.stdout.close()
+            return False
+
+        lines = (self.progress_rest + data).split(b"\n")
+        self.progress_rest = lines.pop()
+        for line in lines:
+            if not self.first_packet and line.startswith(b"out_time_us=") and line[12:].strip().isdigit() \
+                    and int(line[12:]) > 0:
+                self.first_packet = True
+                duration = time.monotonic() - self.start_time
+                TimingController.add_sample(
+                    "first_packet", duration)
+                log.debug(
+                    f"[FFmpeg] [{self.pid}] First audio after {duration * 1000:.0f} ms")
+        return True
 
-            log.info(f"[FFmpeg] [{self.pid}] terminated")
+    @staticmethod
+    def codec_params(output_format: str):
+        return _output_profiles[output_format]["codec"].format(
+            flac_level=_flac_compression_level, bitrate=_bitrate).split()
 
-            # Sometimes this is not enough and ffmpeg survives, so we have to kill it after some time
-            time.sleep(1)
+    # Codec params plus space for the cover art in the PADDING block
+    @staticmethod
+    def output_params(output_format: str):
+        params = FFmpeg.codec_params(output_format)
+        if _add_cover_art and _output_profiles[output_format]["cover_art"] == "flac":
+            params += ['-metadata_header_padding',
+                       str(_flac_cover_art_padding)]
+        return params
+
+    # Ask FFmpeg to finish the file, like pressing "q" in the terminal (it flushes the encoder and writes the headers)
+    def request_stop(self):
+        try:
+            self.process.stdin.write(b"q")
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # Already exited or closed
+            pass
 
-            if self.process.poll() == None:
-                # None means it has no return code (yet), with other words: it is still running
+        log.info(f"[FFmpeg] [{self.pid}] stopping")
 
-                self.process.kill()
+    # What is sent when FFmpeg did not exit in time after the step before: SIGTERM (FFmpeg still finishes the file), then SIGKILL
+    def stop_escalations(self):
+        return [("terminated", self.process.terminate), ("killed", self.process.kill)]
 
-                log.info(f"[FFmpeg] [{self.pid}] killed")
+    # The blocking version of this method waits until the process is dead
+    def stop_blocking(self):
+        # Remove from instances list (and stop)
+        if self in self.session.ffmpeg_instances:
+            self.session.ffmpeg_instances.remove(self)
+
+            start = time.perf_counter()
+            self.request_stop()
+
+            for name, escalate in self.stop_escalations():
+                try:
+                    self.wait(TimingController.ffmpeg_stop_timeout())
+                    break
+                except subprocess.TimeoutExpired:
+                    escalate()
+                    log.info(f"[FFmpeg] [{self.pid}] {name}")
             else:
-                global is_shutting_down
-                if not is_shutting_down:  # Do not post-process unfinished recordings
-                    tmp_file = os.path.join(
-                        self.out_dir, self.filename)
-                    new_file = os.path.join(self.out_dir,
-                                            self.filename[len(self.tmp_file_prefix):])
-                    if os.path.exists(tmp_file):
-                        shutil.move(tmp_file, new_file)
-                        log.debug(
-                            f"[FFmpeg] [{self.pid}] Successfully renamed {self.filename}")
-                        global _add_cover_art
-                        if _add_cover_art:
-                            class AddCoverArtThread(Thread):
-                                def __init__(self, parent, fullfilepath):
-                                    Thread.__init__(self)
-                                    self.parent = parent
-                                    self.fullfilepath = fullfilepath
-
-                                def run(self):
-                                    self.parent.add_cover_art(
-                                        self.fullfilepath)
-
-                            add_cover_art_thread = AddCoverArtThread(
-                                self, new_file)
-                            add_cover_art_thread.start()
-                    else:
-                        log.warning(
-                            f"[FFmpeg] [{self.pid}] Failed renaming {self.filename}")
-
-            # Remove process from memory (and don't left a ffmpeg 'zombie' process)
-            self.process = None
+                self.wait()
+
+            self.finish_stop(start)
+
+    # Wait for the process to exit (raises subprocess.TimeoutExpired)
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.reap():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.process.args, timeout)
+            Shell.wait_exit(self.process.pid, remaining)
+        return self.process.returncode
+
+    # Returns True if the process has exited (without waiting), also collects its CPU time and peak memory
+    def reap(self):
+        try:
+            pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped by subprocess
+            self.process.wait()
+            return True
+        if pid == 0:
+            return False
+
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        self.metrics["encoder_cpu_seconds"] = round(
+            rusage.ru_utime + rusage.ru_stime, 3)
+        self.metrics["encoder_peak_rss_bytes"] = rusage.ru_maxrss * 1024
+        return True
+
+    # Stop a recording which is not needed anymore (its track was skipped before it was played)
+    def abort(self):
+        self.discard = True
+        self.stop()
+
+    # Called when a stopped recording exited, only a clean exit means that the file was finished
+    def finish_stop(self, start: float):
+        if self.discard:
+            self.remove_file()
+            log.info(f"[FFmpeg] [{self.pid}] Recording discarded")
+        elif self.process.returncode == 0:
+            TimingController.add_sample(
+                "stop", time.perf_counter() - start)
+            self.post_process()
+        else:
+            log.warning(
+                f"[FFmpeg] [{self.pid}] Exited with code {self.process.returncode}, the file may not be finished")
+            self.post_process(clean=False)
+
+        # Remove process from memory (and don't left a ffmpeg 'zombie' process)
+        self.process = None
+
+    # Removes the (hidden) file of an unfinished recording
+    def remove_file(self):
+        tmp_file = os.path.join(self.out_dir, self.filename)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    # Close stdin of an encode() process and wait until it has written the file
+    # Returns False if encoding failed (the file is not post-processed then)
+    def finish_encoding(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.wait()
+        self.process = None
+
+        if returncode == 0:
+            log.info(f"[FFmpeg] [{self.pid}] Encoding finished")
+            self.post_process()
+            return True
+
+        log.warning(
+            f"[FFmpeg] [{self.pid}] Encoding failed with exit code {returncode}")
+        return False
+
+    # A new encoder for the same file (to encode the track again from the capture buffer)
+    def encode_again(self):
+        ff = FFmpeg(self.session)
+        ff.encode(self.out_dir, self.file, dict(self.metadata_for_file))
+        return ff
+
+    # Rename the finished file and add the cover art
+    # Files which were not finished cleanly are repaired first
+    def post_process(self, clean=True):
+        global is_shutting_down
+        if is_shutting_down:  # Do not post-process unfinished recordings
+            return
 
-    # Kill the process in the background
-    def stop(self):
-        class KillThread(Thread):
-            def __init__(self, parent, *args):
-                Thread.__init__(self)
-                self.parent = parent
+        tmp_file = os.path.join(
+            self.out_dir, self.filename)
+        # Existing files are not overwritten
+        new_file = FilenameTemplate.unique_path(os.path.join(self.out_dir,
+                                                             self.final_filename))
+        if not os.path.exists(tmp_file):
+            log.warning(
+                f"[FFmpeg] [{self.pid}] Failed renaming {self.filename}")
+            return
 
-            def run(self):
-                self.parent.stop_blocking()
+        if not clean:
+            PostProcessing.submit(
+                "repair of " + os.path.basename(new_file), self.repair_file, tmp_file, new_file)
+            return
 
-        kill_thread = KillThread(self)
-        kill_thread.start()
+        shutil.move(tmp_file, new_file)
+        log.debug(
+            f"[FFmpeg] [{self.pid}] Successfully renamed {self.filename}")
+        if FFmpeg.needs_finish_file():
+            PostProcessing.submit(
+                "post-processing of " + os.path.basename(new_file), self.finish_file, new_file)
+        else:
+            self.deliver(new_file)
 
-    # add cover art to temp _withArtwork file
-    # and then move it to replace the original file
-    def add_cover_art(self, fullfilepath):
-        if self.cover_url is None:
-            log.debug(f'[FFmpeg] No cover art found for {fullfilepath}')
-            return
-        # save the image locally -> could use a temp file here
-        #   but might add option to keep image later
-        cover_file = fullfilepath.rsplit(
-            '.flac', 1)[0]  # remove the extension
-        log.debug(f'Saving cover art to {cover_file} + image_ext')
-        temp_file = cover_file + '_withArtwork.' + 'flac'
-        if self.cover_url.startswith('file://'):
-            log.debug(f'[FFmpeg] Cover art is local for {fullfilepath}')
-            path = self.cover_url[len('file://'):]
-            _, ext = os.path.splitext(path)
-            cover_file += ext
-            shutil.copy2(path, cover_file)
+    # True if the finished files have to go through finish_file()
+    @staticmethod
+    def needs_finish_file():
+        return _add_cover_art or _transcode_format is not None or _trim_silence or _skip_recorded
+
+    # Runs in a PostProcessing worker
+    # Writes the audio of an unfinished file into a new one, which gets correct headers
+    # FLAC is encoded again (lossless), because a copy would keep the empty STREAMINFO, the lossy formats are only remuxed
+    def repair_file(self, tmp_file, new_file):
+        if _output_format == "flac":
+            codec_params = FFmpeg.output_params(_output_format)
         else:
-            log.debug(f'[FFmpeg] Cover art is on server for {fullfilepath}')
-            answer = requests.get(self.cover_url)
-            if not answer.ok:
-                log.debug(
-                    f'[FFmpeg] Cover art not loaded from server for {fullfilepath}')
-                return
-            cover_file += "." + answer.headers["Content-Type"].rsplit("/")[-1]
-            with open(cover_file, "wb") as fd:
-                fd.write(answer.content)
-        # add it to a temporary file
-        log.debug(f'[FFmpeg] Merging cover art into {fullfilepath}')
-        # no need for separate thread / logging here because quick
-        returncode = Shell.run(_ffmpeg_executable + ' ' +
-                               '-y -i {} -i {} -map 0:a -map 1 '.format(
-                                   shlex.quote(fullfilepath), shlex.quote(cover_file)) +
-                               '-codec copy -id3v2_version 3 ' +
-                               '-metadata:s:v title="Album cover" ' +
-                               '-metadata:s:v comment="Cover (front)" ' +
-                               '-disposition:v attached_pic ' +
-                               shlex.quote(temp_file)).returncode
+            codec_params = ['-codec', 'copy']
+        returncode = Shell.run([_ffmpeg_executable, '-hide_banner', '-y', '-i', tmp_file,
+                                '-map', '0:a', '-map_metadata', '0'] + codec_params + [new_file]).returncode
         if returncode != 0:
-            log.warning(f"[FFmpeg] Failed adding artwork to {fullfilepath}")
+            log.warning(
+                f"[FFmpeg] [{self.pid}] Failed repairing {self.filename}, the unfinished recording is kept")
+            if os.path.exists(new_file):
+                os.remove(new_file)
             return
-        # overwrite the actual file by the temp file
-        log.debug(
-            f'[FFmpeg] Added cover art for {fullfilepath} in temp file, moving it')
-        shutil.move(temp_file, fullfilepath)
-        os.remove(cover_file)   # now delete the cover art
-
-    @staticmethod
-    def killAll():
-        log.info("[FFmpeg] Killing all instances")
 
-        # Run as long as list ist not empty
-        while FFmpeg.instances:
-            FFmpeg.instances[0].stop_blocking()
+        os.remove(tmp_file)
+        log.info(f"[FFmpeg] [{self.pid}] Repaired {os.path.basename(new_file)}")
+        self.metrics["repaired"] = True
+        if FFmpeg.needs_finish_file():
+            self.finish_file(new_file)
+        else:
+            self.deliver(new_file)
 
-        log.info("[FFmpeg] All instances killed")
+    # Stop the process without blocking the event loop, it is reaped when its pidfd becomes readable
+    # (or by a polling timer on kernels without pidfd), the stop escalates if it does not exit in time
+    def stop(self):
+        if self not in self.session.ffmpeg_instances:
+            return
+        self.session.ffmpeg_instances.remove(self)
 
+        start = time.perf_counter()
+        self.request_stop()
 
-class Shell:
-    @staticmethod
-    def run(cmd):
-        # 'run()' waits until the process is done
-        log.debug(f"[Shell] run: {cmd}")
-        if _debug_logging:
-            return subprocess.run(cmd.encode(_shell_encoding), stdin=None, shell=True, executable=_shell_executable, encoding=_shell_encoding)
-        else:
-            with open("/dev/null", "w") as devnull:
-                return subprocess.run(cmd.encode(_shell_encoding), stdin=None, stdout=devnull, stderr=devnull, shell=True, executable=_shell_executable, encoding=_shell_encoding)
+        pidfd = Shell.pidfd_open(self.process.pid)
+        escalations = self.stop_escalations()
 
-    @staticmethod
-    def Popen(cmd):
-        # 'Popen()' continues running in the background
-        log.debug(f"[Shell] Popen: {cmd}")
-        if _debug_logging:
-            return subprocess.Popen(cmd.encode(_shell_encoding), stdin=None, shell=True, executable=_shell_executable, encoding=_shell_encoding)
-        else:
-            with open("/dev/null", "w") as devnull:
-                return subprocess.Popen(cmd.encode(_shell_encoding), stdin=None, stdout=devnull, stderr=devnull, shell=True, executable=_shell_executable, encoding=_shell_encoding)
+        def escalate():
+            name, send = escalations.pop(0)
+            send()
+            log.info(f"[FFmpeg] [{self.pid}] {name}")
+            return len(escalations) > 0
 
-    @staticmethod
-    def check_output(cmd):
-        log.debug(f"[Shell] check_output: {cmd}")
-        out = subprocess.check_output(cmd.encode(
-            _shell_encoding), shell=True, executable=_shell_executable, encoding=_shell_encoding)
-        # when not using 'encoding=' -> out.decode()
-        # but since it is set, decode() ist not needed anymore
-        # out = out.decode()
-        return out.rstrip('\n')
+        escalation_timer = GLib.timeout_add(
+            int(TimingController.ffmpeg_stop_timeout() * 1000), escalate)
 
+        def check_exited(*args):
+            if not self.reap():
+                return True
 
-class PulseAudio:
-    sink_id = ""
+            if pidfd is not None:
+                os.close(pidfd)
+            if escalations:
+                GLib.source_remove(escalation_timer)
 
-    @staticmethod
-    def load_sink():
-        log.info(f"[{app_name}] Creating pulse sink")
+            self.finish_stop(start)
+            return False
 
-        if _mute_pa_recording_sink:
-            PulseAudio.sink_id = Shell.check_output('pactl load-module module-null-sink sink_name="' + _pa_recording_sink_name +
-                                                    '" sink_properties=device.description="' + _pa_recording_sink_name + '" rate=44100 channels=2')
+        if pidfd is not None:
+            GLib.io_add_watch(pidfd, GLib.PRIORITY_DEFAULT,
+                              GLib.IO_IN, check_exited)
         else:
-            PulseAudio.sink_id = Shell.check_output('pactl load-module module-remap-sink sink_name="' + _pa_recording_sink_name +
-                                                    '" sink_properties=device.description="' + _pa_recording_sink_name + '" rate=44100 channels=2 remix=no')
-            # To use another master sink where to play:
-            # pactl load-module module-remap-sink sink_name=spotrec sink_properties=device.description="spotrec" master=MASTER_SINK_NAME channels=2 remix=no
+            GLib.timeout_add(_ffmpeg_reap_interval_ms, check_exited)
 
-    @staticmethod
-    def unload_sink():
-        log.info(f"[{app_name}] Unloading pulse sink")
-        Shell.run('pactl unload-module ' + PulseAudio.sink_id)
+    # Runs in a PostProcessing worker
+    def finish_file(self, fullfilepath):
+        start = time.monotonic()
 
-    @staticmethod
-    def init_spotify_sink_input_id():
-        global pa_spotify_sink_input_id
+        # Trimming re-encodes the file, so it has to run before the cover art is added
+        if _trim_silence:
+            self.trim_silence(fullfilepath)
 
-        if pa_spotify_sink_input_id > -1:
-            return
+        if _add_cover_art:
+            self.add_cover_art(fullfilepath, _output_format)
 
-        application_name = "spotify"
-        cmdout = Shell.check_output(
-            "pactl list sink-inputs | awk '{print tolower($0)};' | awk '/ #/ {print $0} /application.name = \"" + application_name + "\"/ {print $3};'")
-        index = -1
-        last = ""
+        if _transcode_format is not None and _transcode_format != _output_format:
+            fullfilepath = self.transcode(fullfilepath, _transcode_format)
 
-        for line in cmdout.split('\n'):
-            if line == '"' + application_name + '"':
-                index = last.split(" #", 1)[1]
-                break
-            last = line
+        self.metrics["post_processing_seconds"] = round(
+            time.monotonic() - start, 3)
+        self.deliver(fullfilepath)
 
-        # Alternative command:
-        # for i in $(LC_ALL=C pactl list | grep -E '(^Sink Input)|(media.name = \"Spotify\"$)' | cut -d \# -f2 | grep -v Spotify); do echo "$i"; done
+    # The file is finished, it is moved from the staging directory first (if enabled)
+    def deliver(self, fullfilepath):
+        if _staging_directory is not None:
+            Mover.submit(fullfilepath, self)
+        else:
+            self.delivered(fullfilepath)
 
-        pa_spotify_sink_input_id = int(index)
+    # The file is in the output directory
+    # sha256: hex digest of the file if it is already known (computed while moving it)
+    def delivered(self, fullfilepath, sha256=None):
+        if _skip_recorded and self.trackid is not None:
+            RecordingIndex.add(self.trackid, fullfilepath,
+                               FFmpeg.get_duration(fullfilepath, self.expected_length), sha256)
 
-    @staticmethod
-    def move_spotify_to_own_sink():
-        class MoveSpotifyToSinktThread(Thread):
-            def run(self):
-                if pa_spotify_sink_input_id > -1:
-                    exit_code = Shell.run("pactl move-sink-input " + str(
-                        pa_spotify_sink_input_id) + " " + _pa_recording_sink_name).returncode
+        Metrics.track_finished(self, fullfilepath)
 
-                    if exit_code == 0:
-                        log.info(f"[{app_name}] Moved Spotify to own sink")
-                    else:
-                        log.warning(
-                            f"[{app_name}] Failed to move Spotify to own sink")
+    # Length of the finished file (from STREAMINFO for FLAC, otherwise as reported by Spotify)
+    @staticmethod
+    def get_duration(fullfilepath, expected_length):
+        try:
+            info = FlacMetadata(fullfilepath).get_streaminfo()
+            return info["total_samples"] / info["sample_rate"]
+        except (OSError, ValueError):
+            return expected_length
 
-        move_spotify_to_sink_thread = MoveSpotifyToSinktThread()
-        move_spotify_to_sink_thread.start()
+    def add_cover_art(self, fullfilepath, output_format):
+        if not CoverArtCache.is_valid_url(self.cover_url):
+            log.debug(f'[FFmpeg] No cover art found for {fullfilepath}')
+            return
+        cover = CoverArtCache.get(self.cover_url)
+        if cover is None:
+            log.debug(
+                f'[FFmpeg] Cover art not loaded for {fullfilepath}')
+            return
+        data, mime_type = cover
+        mime_type = mime_type or "image/jpeg"
+
+        method = _output_profiles[output_format]["cover_art"]
+        if method == "flac":
+            self.add_cover_art_flac(fullfilepath, data, mime_type)
+        elif method == "vorbis_comment":
+            self.add_cover_art_vorbis_comment(
+                fullfilepath, data, mime_type)
+        else:
+            self.add_cover_art_attached_pic(fullfilepath)
 
-    @staticmethod
-    def set_sink_volumes_to_100():
+    # add cover art as PICTURE block, usually in place (using the padding reserved at record time)
+    def add_cover_art_flac(self, fullfilepath, data, mime_type):
+        try:
+            flac = FlacMetadata(fullfilepath)
+            flac.set_picture(data, mime_type)
+            if flac.save():
+                log.debug(f'[FFmpeg] Added cover art in place to {fullfilepath}')
+            else:
+                log.debug(
+                    f'[FFmpeg] Added cover art to {fullfilepath} (not enough padding, file rewritten)')
+        except (OSError, ValueError) as e:
+            log.warning(
+                f"[FFmpeg] Failed adding artwork to {fullfilepath}: {e}")
+
+    # add cover art to temp _withArtwork file
+    # and then move it to replace the original file
+    def add_cover_art_attached_pic(self, fullfilepath):
+        cover_file = CoverArtCache.get_path(self.cover_url)
+        if cover_file is None:
+            return
+        base, ext = os.path.splitext(fullfilepath)
+        temp_file = base + '_withArtwork' + ext
+        log.debug(f'[FFmpeg] Merging cover art into {fullfilepath}')
+        returncode = Shell.run([_ffmpeg_executable,
+                                '-y', '-i', fullfilepath, '-i', cover_file, '-map', '0:a', '-map', '1',
+                                '-codec', 'copy', '-id3v2_version', '3',
+                                '-metadata:s:v', 'title=Album cover',
+                                '-metadata:s:v', 'comment=Cover (front)',
+                                '-disposition:v', 'attached_pic',
+                                temp_file]).returncode
+        if returncode != 0:
+            log.warning(f"[FFmpeg] Failed adding artwork to {fullfilepath}")
+            return
+        # overwrite the actual file by the temp file
+        shutil.move(temp_file, fullfilepath)
+
+    # Ogg can't hold an attached picture stream, it uses a base64 encoded FLAC PICTURE block as comment
+    # The comment is too long for the command line, so it is passed in an ffmetadata file
+    def add_cover_art_vorbis_comment(self, fullfilepath, data, mime_type):
+        base, ext = os.path.splitext(fullfilepath)
+        temp_file = base + '_withArtwork' + ext
+        meta_file = base + '_metadata.txt'
+
+        # Dump the existing tags, then append the picture
+        returncode = Shell.run([_ffmpeg_executable, '-y', '-i', fullfilepath,
+                                '-f', 'ffmetadata', meta_file]).returncode
+        if returncode == 0:
+            picture = base64.b64encode(
+                FlacMetadata.build_picture(data, mime_type)).decode("ascii")
+            with open(meta_file, "a") as fd:
+                fd.write("METADATA_BLOCK_PICTURE=" +
+                         picture.replace("=", "\\=") + "\n")
+
+            returncode = Shell.run([_ffmpeg_executable, '-y', '-i', fullfilepath,
+                                    '-f', 'ffmetadata', '-i', meta_file,
+                                    '-map', '0:a', '-map_metadata', '1', '-codec', 'copy',
+                                    temp_file]).returncode
+
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+
+        if returncode != 0:
+            log.warning(f"[FFmpeg] Failed adding artwork to {fullfilepath}")
+            return
+        shutil.move(temp_file, fullfilepath)
+
+    # Cut the file to the real start and end of the audio and compare its length with the one reported by Spotify
+    def trim_silence(self, fullfilepath):
+        bounds = SilenceDetector.find_audio_bounds(fullfilepath)
+        if bounds is None:
+            log.warning(f"[FFmpeg] Could not analyse {fullfilepath}")
+            return
+        start, end, total = bounds
+
+        if end <= start:
+            self.trim_verdict = "silent"
+            log.warning(f"[FFmpeg] {fullfilepath} is silent")
+            return
+
+        # The overhead at the end may contain the beginning of the next track (which is no silence)
+        if self.expected_length and end - start > self.expected_length + _trim_tail_tolerance:
+            end = start + self.expected_length
+
+        start = max(0.0, start - _silence_margin)
+        end = min(total, end + _silence_margin)
+        length = end - start
+
+        if self.expected_length and abs(length - self.expected_length) > _track_length_tolerance:
+            self.trim_verdict = "length_mismatch"
+            log.warning(
+                f"[FFmpeg] {fullfilepath} has {length:.2f} s of audio, but Spotify reported {self.expected_length:.2f} s (clipped?)")
+        else:
+            self.trim_verdict = "ok"
+
+        if start < _silence_frame_seconds and total - end < _silence_frame_seconds:
+            return
+
+        # FLAC is encoded again (lossless, exact cut), the lossy formats are only cut at packet boundaries,
+        # encoding them again would add generation loss
+        if _output_format == "flac":
+            codec_params = FFmpeg.output_params(_output_format)
+        else:
+            codec_params = ['-codec', 'copy']
+        base, ext = os.path.splitext(fullfilepath)
+        temp_file = base + '_trimmed' + ext
+        returncode = Shell.run([_ffmpeg_executable, '-hide_banner', '-y', '-i', fullfilepath,
+                                '-ss', f'{start:.3f}', '-to', f'{end:.3f}', '-map', '0:a', '-map_metadata', '0'] +
+                               codec_params + [temp_file]).returncode
+        if returncode != 0:
+            log.warning(f"[FFmpeg] Failed trimming {fullfilepath}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            return
+
+        shutil.move(temp_file, fullfilepath)
+        log.info(
+            f"[FFmpeg] Trimmed {start:.2f} s at the start and {total - end:.2f} s at the end of {os.path.basename(fullfilepath)}")
+
+    # Transcode a finished recording, the new file replaces the recording
+    # Returns the path of the new file (or of the recording if transcoding failed)
+    def transcode(self, fullfilepath, output_format):
+        out_dir, name = os.path.split(os.path.splitext(fullfilepath)[0])
+        ext = _output_profiles[output_format]["extension"]
+        tmp_file = os.path.join(out_dir, self.tmp_file_prefix + name + "." + ext)
+        new_file = FilenameTemplate.unique_path(
+            os.path.join(out_dir, name + "." + ext))
+
+        returncode = Shell.run([_ffmpeg_executable, '-hide_banner', '-y', '-i', fullfilepath,
+                                '-map', '0:a', '-map_metadata', '0'] + FFmpeg.codec_params(output_format) +
+                               [tmp_file]).returncode
+        if returncode != 0:
+            log.warning(f"[FFmpeg] Failed transcoding {fullfilepath}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return fullfilepath
+
+        if _add_cover_art:
+            self.add_cover_art(tmp_file, output_format)
+
+        shutil.move(tmp_file, new_file)
+        os.remove(fullfilepath)
+        log.info(f"[FFmpeg] Transcoded {name} to {output_format}")
+        return new_file
+
+    @staticmethod
+    def killAll(session: Session):
+        log.info("[FFmpeg] Killing all instances")
+
+        # Run as long as list ist not empty
+        while session.ffmpeg_instances:
+            session.ffmpeg_instances[0].stop_blocking()
+
+        log.info("[FFmpeg] All instances killed")
+
+
+# Finds the real start and end of the audio in a file
+# The file is decoded by FFmpeg and streamed through NumPy in chunks, the RMS is computed per 10 ms frame
+class SilenceDetector:
+    chunk_frames = 1000  # 10 s per read
+
+    # Returns (start, end, total length) in seconds or None
+    @staticmethod
+    def find_audio_bounds(path: str):
+        frame_samples = int(_pcm_sample_rate * _silence_frame_seconds)
+        frame_bytes = frame_samples * _pcm_channels * _pcm_sample_width
+        threshold = 32768 * 10 ** (_silence_threshold / 20)
+
+        process = Shell.Popen([_ffmpeg_executable, "-v", "error", "-i", path,
+                               "-f", "s16le", "-ac", str(_pcm_channels), "-ar", str(_pcm_sample_rate), "pipe:1"],
+                              stdout=subprocess.PIPE)
+
+        first = None
+        last = None
+        frames = 0
+        rest = b""
+        while True:
+            data = process.stdout.read(frame_bytes * SilenceDetector.chunk_frames)
+            if not data:
+                break
+            data = rest + data
+            usable = len(data) - len(data) % frame_bytes
+            rest = data[usable:]
+            if usable == 0:
+                continue
+
+            samples = numpy.frombuffer(data[:usable], dtype="<i2").astype(
+                numpy.float32).reshape(-1, frame_samples * _pcm_channels)
+            rms = numpy.sqrt(numpy.mean(samples * samples, axis=1))
+            loud = numpy.flatnonzero(rms > threshold)
+            if len(loud):
+                if first is None:
+                    first = frames + int(loud[0])
+                last = frames + int(loud[-1])
+            frames += len(rms)
+
+        if process.wait() != 0:
+            return None
+
+        total = (frames * frame_bytes + len(rest)) / \
+            (_pcm_sample_rate * _pcm_channels * _pcm_sample_width)
+        if first is None:
+            return 0.0, 0.0, total
+        return first * _silence_frame_seconds, (last + 1) * _silence_frame_seconds, total
+
+
+# Reads and writes the metadata blocks of a FLAC file
+# Changes are written in place if they fit into the existing metadata and PADDING, so the audio frames are not copied
+class FlacMetadata:
+    STREAMINFO = 0
+    PADDING = 1
+    VORBIS_COMMENT = 4
+    PICTURE = 6
+
+    def __init__(self, path: str):
+        self.path = path
+        self.blocks = []  # [block type, data]
+
+        with open(path, "rb") as fd:
+            if fd.read(4) != b"fLaC":
+                raise ValueError(f"{path} is not a FLAC file")
+
+            last = False
+            while not last:
+                header = fd.read(4)
+                if len(header) < 4:
+                    raise ValueError(f"{path} has truncated metadata")
+                last = bool(header[0] & 0x80)
+                length = int.from_bytes(header[1:4], "big")
+                data = fd.read(length)
+                if len(data) < length:
+                    raise ValueError(f"{path} has truncated metadata")
+                self.blocks.append([header[0] & 0x7f, data])
+
+            # The audio frames start after the last metadata block
+            self.audio_offset = fd.tell()
+
+    def get_blocks(self, block_type: int):
+        return [data for t, data in self.blocks if t == block_type]
+
+    def remove_blocks(self, block_type: int):
+        self.blocks = [b for b in self.blocks if b[0] != block_type]
+
+    def get_streaminfo(self):
+        data = self.get_blocks(self.STREAMINFO)[0]
+        # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+        packed = int.from_bytes(data[10:18], "big")
+        return {
+            "sample_rate": packed >> 44,
+            "channels": ((packed >> 41) & 0x7) + 1,
+            "bits_per_sample": ((packed >> 36) & 0x1f) + 1,
+            "total_samples": packed & 0xfffffffff,
+            "md5": data[18:34],
+        }
+
+    # Returns the vendor string and a list of (key, value)
+    def get_vorbis_comment(self):
+        blocks = self.get_blocks(self.VORBIS_COMMENT)
+        if not blocks:
+            return "", []
+        data = blocks[0]
+
+        length = struct.unpack_from("<I", data, 0)[0]
+        vendor = data[4:4 + length].decode("utf-8", "replace")
+        pos = 4 + length
+        count = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        comments = []
+        for _ in range(count):
+            length = struct.unpack_from("<I", data, pos)[0]
+            key, _, value = data[pos + 4:pos + 4 +
+                                 length].decode("utf-8", "replace").partition("=")
+            comments.append((key, value))
+            pos += 4 + length
+        return vendor, comments
+
+    def set_vorbis_comment(self, vendor: str, comments):
+        data = bytearray()
+        vendor = vendor.encode("utf-8")
+        data += struct.pack("<I", len(vendor)) + vendor
+        data += struct.pack("<I", len(comments))
+        for key, value in comments:
+            comment = (key + "=" + value).encode("utf-8")
+            data += struct.pack("<I", len(comment)) + comment
+
+        # VORBIS_COMMENT has to stay in its place (right after STREAMINFO)
+        for block in self.blocks:
+            if block[0] == self.VORBIS_COMMENT:
+                block[1] = bytes(data)
+                return
+        self.blocks.insert(1, [self.VORBIS_COMMENT, bytes(data)])
+
+    def set_picture(self, image: bytes, mime_type: str, description="Album cover", picture_type=3):
+        self.blocks = [b for b in self.blocks if b[0] != self.PICTURE or
+                       struct.unpack_from(">I", b[1], 0)[0] != picture_type]
+        self.blocks.append([self.PICTURE, self.build_picture(
+            image, mime_type, description, picture_type)])
+
+    # Picture type 3: front cover (width, height, depth and colors may be 0 if unknown)
+    @staticmethod
+    def build_picture(image: bytes, mime_type: str, description="Album cover", picture_type=3):
+        mime_type = mime_type.encode("ascii")
+        description = description.encode("utf-8")
+        data = struct.pack(">I", picture_type)
+        data += struct.pack(">I", len(mime_type)) + mime_type
+        data += struct.pack(">I", len(description)) + description
+        data += struct.pack(">IIIII", 0, 0, 0, 0, len(image)) + image
+        return data
+
+    @staticmethod
+    def encode_blocks(blocks):
+        out = bytearray()
+        for i, (block_type, data) in enumerate(blocks):
+            last = 0x80 if i == len(blocks) - 1 else 0
+            out += bytes([last | block_type]) + len(data).to_bytes(3, "big")
+            out += data
+        return out
+
+    # True if save() can write the metadata in place (it fits exactly or leaves room for a PADDING block)
+    def fits_in_place(self):
+        size = sum(4 + len(data) for t, data in self.blocks if t != self.PADDING)
+        available = self.audio_offset - 4
+        return size == available or size + 4 <= available
+
+    # Returns True if the metadata was written in place, False if the file had to be rewritten
+    def save(self):
+        blocks = [b for b in self.blocks if b[0] != self.PADDING]
+        size = sum(4 + len(data) for _, data in blocks)
+        available = self.audio_offset - 4
+
+        if self.fits_in_place():
+            if size < available:
+                blocks.append([self.PADDING, bytes(available - size - 4)])
+            with open(self.path, "r+b") as fd:
+                fd.seek(4)
+                fd.write(self.encode_blocks(blocks))
+            self.blocks = blocks
+            return True
+
+        # Not enough space, write a new file with new padding
+        blocks.append([self.PADDING, bytes(_flac_cover_art_padding)])
+        tmp_file = self.path + ".tmp"
+        with open(self.path, "rb") as src, open(tmp_file, "wb") as dst:
+            dst.write(b"fLaC" + self.encode_blocks(blocks))
+            src.seek(self.audio_offset)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_file, self.path)
+
+        self.audio_offset = 4 + sum(4 + len(data) for _, data in blocks)
+        self.blocks = blocks
+        return False
+
+
+# Shared HTTP session, keeps the connections to the image server alive between the tracks
+class Http:
+    session = None
+    lock = Lock()
+    latencies = []
+    failures = 0
+
+    @staticmethod
+    def get_session():
+        with Http.lock:
+            if Http.session is None:
+                retry = Retry(total=_http_retries, backoff_factor=_http_retry_backoff,
+                              status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",),
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=_post_processing_workers + 1,
+                                      max_retries=retry)
+                Http.session = requests.Session()
+                Http.session.mount("https://", adapter)
+                Http.session.mount("http://", adapter)
+            return Http.session
+
+    # Returns the response or None if the request failed (after all retries)
+    @staticmethod
+    def get(url: str):
+        session = Http.get_session()
+        start = time.perf_counter()
+        try:
+            answer = session.get(url, timeout=(
+                _http_connect_timeout, _http_read_timeout))
+        except requests.RequestException as e:
+            log.debug(f"[HTTP] GET {url} failed: {e}")
+            answer = None
+
+        with Http.lock:
+            if answer is None or not answer.ok:
+                Http.failures += 1
+            else:
+                Http.latencies.append(time.perf_counter() - start)
+        return answer
+
+    @staticmethod
+    def log_metrics():
+        with Http.lock:
+            if not Http.latencies and not Http.failures:
+                return
+
+            if Http.latencies:
+                log.info(f"[HTTP] {len(Http.latencies)} fetches, {Http.failures} failed, "
+                         f"median {percentile(Http.latencies, 50) * 1000:.0f} ms, "
+                         f"p95 {percentile(Http.latencies, 95) * 1000:.0f} ms, "
+                         f"max {max(Http.latencies) * 1000:.0f} ms")
+            else:
+                log.info(f"[HTTP] {Http.failures} fetches failed")
+
+
+# Cover art cache, images are stored content-addressed (by their sha256) in _cover_cache_directory
+# An index maps the artUrl to the file, the most recently used images are also kept in memory
+class CoverArtCache:
+    index = {}  # artUrl -> file name
+    memory = OrderedDict()  # artUrl -> (image data, mime type)
+    pending = {}  # artUrl -> Event, set when the running fetch has finished
+    lock = Lock()
+    prefetch_queue = None
+
+    @staticmethod
+    def init():
+        Path(_cover_cache_directory).mkdir(
+            parents=True, exist_ok=True)
+
+        try:
+            with open(CoverArtCache.index_file()) as fd:
+                CoverArtCache.index = json.load(fd)
+        except (OSError, ValueError):
+            CoverArtCache.index = {}
+
+        CoverArtCache.prefetch_queue = queue.Queue()
+
+        class CoverArtPrefetchThread(Thread):
+            def __init__(self):
+                Thread.__init__(self)
+                self.daemon = True
+
+            def run(self):
+                while True:
+                    url = CoverArtCache.prefetch_queue.get()
+                    try:
+                        CoverArtCache.get(url)
+                    except Exception:
+                        log.warning(
+                            f"[CoverArt] Failed prefetching {url}:\n{traceback.format_exc()}")
+
+        cover_art_prefetch_thread = CoverArtPrefetchThread()
+        cover_art_prefetch_thread.start()
+
+    @staticmethod
+    def index_file():
+        return os.path.join(_cover_cache_directory, "index.json")
+
+    @staticmethod
+    def is_valid_url(url):
+        return url is not None and url != "None" and url != ""
+
+    @staticmethod
+    def prefetch(url):
+        if CoverArtCache.prefetch_queue is None or not CoverArtCache.is_valid_url(url):
+            return
+
+        with CoverArtCache.lock:
+            if url in CoverArtCache.memory or url in CoverArtCache.pending:
+                return
+
+        log.debug(f"[CoverArt] Prefetching {url}")
+        CoverArtCache.prefetch_queue.put(url)
+
+    # Returns the path to the cached image file (or None if it could not be fetched)
+    @staticmethod
+    def get_path(url):
+        if CoverArtCache.get(url) is None:
+            return None
+
+        with CoverArtCache.lock:
+            name = CoverArtCache.index.get(url)
+        if name is None:
+            return None
+        return os.path.join(_cover_cache_directory, name)
+
+    # Returns (image data, mime type) or None
+    @staticmethod
+    def get(url):
+        with CoverArtCache.lock:
+            if url in CoverArtCache.memory:
+                CoverArtCache.memory.move_to_end(url)
+                return CoverArtCache.memory[url]
+
+            # Only one thread fetches the same image, others wait for it
+            event = CoverArtCache.pending.get(url)
+            owner = event is None
+            if owner:
+                event = Event()
+                CoverArtCache.pending[url] = event
+
+        if not owner:
+            event.wait()
+            with CoverArtCache.lock:
+                return CoverArtCache.memory.get(url)
+
+        try:
+            result = CoverArtCache.load_from_disk(url)
+            if result is None:
+                result = CoverArtCache.fetch(url)
+                if result is not None:
+                    try:
+                        CoverArtCache.store_on_disk(url, *result)
+                    except OSError as e:
+                        # Still usable from memory (e.g. the disk is full)
+                        log.warning(f"[CoverArt] Failed caching {url}: {e}")
+
+            if result is not None:
+                with CoverArtCache.lock:
+                    CoverArtCache.memory[url] = result
+                    while len(CoverArtCache.memory) > _cover_cache_memory_entries:
+                        CoverArtCache.memory.popitem(last=False)
+            return result
+        finally:
+            with CoverArtCache.lock:
+                CoverArtCache.pending.pop(url, None)
+            event.set()
+
+    @staticmethod
+    def load_from_disk(url):
+        with CoverArtCache.lock:
+            name = CoverArtCache.index.get(url)
+        if name is None:
+            return None
+
+        path = os.path.join(_cover_cache_directory, name)
+        try:
+            with open(path, "rb") as fd:
+                data = fd.read()
+        except OSError:
+            return None
+
+        # The modification time is used as last access time for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since it was read
+            pass
+        log.debug(f"[CoverArt] Cache hit for {url}")
+        return data, mimetypes.guess_type(path)[0]
+
+    @staticmethod
+    def fetch(url):
+        if url.startswith('file://'):
+            path = url[len('file://'):]
+            try:
+                with open(path, "rb") as fd:
+                    return fd.read(), mimetypes.guess_type(path)[0]
+            except OSError:
+                log.debug(f"[CoverArt] Could not read {path}")
+                return None
+
+        answer = Http.get(url)
+        if answer is None or not answer.ok:
+            log.debug(f"[CoverArt] Could not download {url}")
+            return None
+        return answer.content, answer.headers.get("Content-Type", "image/jpeg")
+
+    @staticmethod
+    def store_on_disk(url, data, mime_type):
+        ext = mimetypes.guess_extension(mime_type or "") or ".jpg"
+        name = hashlib.sha256(data).hexdigest() + ext
+        path = os.path.join(_cover_cache_directory, name)
+
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as fd:
+                fd.write(data)
+            os.replace(path + ".tmp", path)
+
+        with CoverArtCache.lock:
+            CoverArtCache.index[url] = name
+            CoverArtCache.evict(keep=name)
+            CoverArtCache.save_index()
+
+    # Remove the least recently used images (except keep) until the cache fits into _cover_cache_size
+    # Has to be called with the lock held
+    @staticmethod
+    def evict(keep=None):
+        files = []
+        total_size = 0
+        with os.scandir(_cover_cache_directory) as entries:
+            for entry in entries:
+                # Files which are being written (*.tmp) are not in the cache yet
+                if entry.name != "index.json" and not entry.name.endswith(".tmp") and entry.is_file():
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.name))
+                    total_size += stat.st_size
+
+        files.sort()
+        max_size = _cover_cache_size * 1024 * 1024
+        removed = set()
+        for _, size, name in files:
+            if total_size <= max_size:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(_cover_cache_directory, name))
+            except FileNotFoundError:
+                pass
+            removed.add(name)
+            total_size -= size
+
+        if removed:
+            log.debug(f"[CoverArt] Evicted {len(removed)} images from the cache")
+            CoverArtCache.index = {url: name for url, name in CoverArtCache.index.items()
+                                   if name not in removed}
+
+    # Has to be called with the lock held
+    @staticmethod
+    def save_index():
+        with open(CoverArtCache.index_file() + ".tmp", "w") as fd:
+            json.dump(CoverArtCache.index, fd)
+        os.replace(CoverArtCache.index_file() + ".tmp",
+                   CoverArtCache.index_file())
+
+
+# Append-only index of the recorded tracks in the output directory (one JSON object per line)
+# It is loaded into a dict keyed by mpris:trackid, so every lookup is O(1)
+class RecordingIndex:
+    entries = {}
+    lock = Lock()
+    # Set if the last line is incomplete, the next entry has to start on a new line
+    needs_newline = False
+
+    @staticmethod
+    def path():
+        return os.path.join(_output_directory, _recording_index_filename)
+
+    @staticmethod
+    def load():
+        RecordingIndex.entries = {}
+        try:
+            with open(RecordingIndex.path()) as fd:
+                for line in fd:
+                    RecordingIndex.needs_newline = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line may be incomplete if SpotRec crashed while writing it
+                        continue
+                    # Later entries replace older ones (the track was recorded again)
+                    RecordingIndex.entries[entry["trackid"]] = entry
+        except OSError:
+            pass
+
+        log.info(
+            f"[{app_name}] {len(RecordingIndex.entries)} tracks in the index of recorded tracks")
+
+    # A track counts as recorded if its file still exists with the same size
+    @staticmethod
+    def is_recorded(trackid: str):
+        with RecordingIndex.lock:
+            entry = RecordingIndex.entries.get(trackid)
+        if entry is None:
+            return False
+
+        try:
+            return os.path.getsize(os.path.join(_output_directory, entry["path"])) == entry["size"]
+        except OSError:
+            return False
+
+    @staticmethod
+    def add(trackid: str, fullfilepath: str, duration: float, sha256=None):
+        if sha256 is None:
+            digest = hashlib.sha256()
+            with open(fullfilepath, "rb") as fd:
+                for block in iter(lambda: fd.read(1024 * 1024), b""):
+                    digest.update(block)
+            sha256 = digest.hexdigest()
+
+        entry = {
+            "trackid": trackid,
+            "path": os.path.relpath(fullfilepath, _output_directory),
+            "duration": round(duration, 3),
+            "size": os.path.getsize(fullfilepath),
+            "sha256": sha256,
+        }
+
+        with RecordingIndex.lock:
+            RecordingIndex.entries[trackid] = entry
+            with open(RecordingIndex.path(), "a") as fd:
+                if RecordingIndex.needs_newline:
+                    fd.write("\n")
+                    RecordingIndex.needs_newline = False
+                fd.write(json.dumps(entry) + "\n")
+
+
+# "spotrec verify": checks the recordings in the output directory after a run
+#  FLAC: every frame is decoded (with CRC check) and the audio is compared with the MD5 and sample count in STREAMINFO
+#  other formats: every frame is decoded
+# The EBU R128 loudness and true peak are measured in the same FFmpeg run, and written as ReplayGain tags into FLAC files
+# The files are checked in a pool of processes, the results are cached by inode and mtime in the output directory,
+# so a new run only checks new and changed files
+class Verifier:
+    pcm_formats = {8: "s8", 16: "s16le", 24: "s24le", 32: "s32le"}
+    loudness_pattern = re.compile(rb"^\s*I:\s+(-?[\d.]+|-inf) LUFS", re.MULTILINE)
+    peak_pattern = re.compile(rb"True peak:\s+Peak:\s+(-?[\d.]+|-inf) dBFS")
+
+    # Returns the exit code: 1 if a file is broken
+    @staticmethod
+    def run(directory: str):
+        start = time.monotonic()
+        cache_path = os.path.join(directory, _verify_cache_filename)
+        cache = Verifier.load_cache(cache_path)
+
+        results = {}
+        todo = []
+        for path in Verifier.find_files(directory):
+            try:
+                key = Verifier.cache_key(os.stat(path))
+            except OSError:
+                continue
+            if key in cache:
+                results[key] = dict(cache[key], file=os.path.relpath(path, directory))
+            else:
+                todo.append(path)
+
+        log.info(f"[Verify] {len(results) + len(todo)} files, {len(results)} unchanged since the last run, "
+                 f"checking {len(todo)} with {_verify_processes} processes")
+
+        # Forked, so the workers have the settings of the command line
+        with ProcessPoolExecutor(max_workers=_verify_processes, mp_context=multiprocessing.get_context("fork")) as executor, \
+                open(cache_path, "a") as cache_fd:
+            for path, result in zip(todo, executor.map(Verifier.verify_file, todo)):
+                result["file"] = os.path.relpath(path, directory)
+                if result["status"] == "broken":
+                    log.warning(
+                        f"[Verify] Broken: {result['file']}: {'; '.join(result['errors'])}")
+                elif result["notes"]:
+                    log.info(
+                        f"[Verify] {result['file']}: {'; '.join(result['notes'])}")
+                else:
+                    log.debug(f"[Verify] OK: {result['file']}")
+
+                key = result.pop("key", None)
+                if key is not None:
+                    results[key] = result
+                    # Written right away, so an interrupted run does not start from the beginning
+                    cache_fd.write(json.dumps(dict(result, key=key)) + "\n")
+                    cache_fd.flush()
+
+        # Rewrite the cache without the files which are gone
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            for key, result in results.items():
+                fd.write(json.dumps(dict(result, key=key)) + "\n")
+        os.replace(tmp_path, cache_path)
+
+        counts = {}
+        for result in results.values():
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        log.info(f"[Verify] Done after {time.monotonic() - start:.1f} s: " +
+                 ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+        for result in results.values():
+            if result["status"] == "broken":
+                log.info(f"[Verify] Broken: {result['file']}")
+
+        return 1 if "broken" in counts else 0
+
+    # The recordings, without the hidden files (unfinished recordings, index files)
+    @staticmethod
+    def find_files(directory: str):
+        extensions = tuple("." + profile["extension"]
+                           for profile in _output_profiles.values())
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if not name.startswith(".") and name.endswith(extensions):
+                    yield os.path.join(root, name)
+
+    @staticmethod
+    def cache_key(stat):
+        return f"{stat.st_ino}:{stat.st_mtime_ns}"
+
+    @staticmethod
+    def load_cache(path: str):
+        cache = {}
+        try:
+            with open(path) as fd:
+                for line in fd:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # Incomplete if the run before was killed while writing
+                        continue
+                    cache[result.pop("key")] = result
+        except OSError:
+            pass
+        return cache
+
+    # Runs in a worker process
+    @staticmethod
+    def verify_file(path: str):
+        # Errors make the file "broken", notes are only reported
+        result = {"status": "ok", "errors": [], "notes": []}
+
+        streaminfo = None
+        pcm_format = None
+        if path.endswith(".flac"):
+            try:
+                flac = FlacMetadata(path)
+                streaminfo = flac.get_streaminfo()
+            except (OSError, ValueError, IndexError) as e:
+                result["status"] = "broken"
+                result["errors"].append(str(e))
+                result["key"] = Verifier.stat_key(path)
+                return result
+            pcm_format = Verifier.pcm_formats.get(
+                streaminfo["bits_per_sample"])
+
+        # One decoder, two outputs: the loudness measurement, and the raw audio to compare with STREAMINFO
+        args = [_ffmpeg_executable, '-hide_banner', '-nostats', '-loglevel', 'level+info', '-err_detect', 'crccheck',
+                '-i', path, '-map', '0:a', '-af', 'ebur128=peak=true:framelog=quiet', '-f', 'null', '-']
+        if pcm_format is not None:
+            args += ['-map', '0:a', '-f', pcm_format, 'pipe:1']
+
+        md5 = hashlib.md5()
+        decoded_bytes = 0
+        # stderr goes to a file, a pipe could fill up while stdout is read
+        with tempfile.TemporaryFile() as stderr:
+            process = Shell.Popen(args, stdout=subprocess.PIPE if pcm_format is not None else None,
+                                  stderr=stderr)
+            if pcm_format is not None:
+                for block in iter(lambda: process.stdout.read(1024 * 1024), b""):
+                    md5.update(block)
+                    decoded_bytes += len(block)
+                process.stdout.close()
+            returncode = process.wait()
+            stderr.seek(0)
+            output = stderr.read()
+
+        for line in output.splitlines():
+            if b"[error]" in line or b"[fatal]" in line:
+                result["errors"].append(line.decode("utf-8", "replace").strip())
+        if returncode != 0:
+            result["errors"].append(f"FFmpeg exit code {returncode}")
+
+        if streaminfo is not None and pcm_format is not None:
+            frame_bytes = streaminfo["channels"] * \
+                ((streaminfo["bits_per_sample"] + 7) // 8)
+            decoded_samples = decoded_bytes // frame_bytes
+            # Files of a killed FFmpeg have no sample count and MD5 (0), they can only be checked for decoding errors
+            if streaminfo["total_samples"] == 0 or streaminfo["md5"] == bytes(16):
+                result["status"] = "unverifiable"
+                result["notes"].append("no MD5 in STREAMINFO")
+            if streaminfo["total_samples"] not in (0, decoded_samples):
+                result["errors"].append(
+                    f"decoded {decoded_samples} of {streaminfo['total_samples']} samples")
+            elif streaminfo["md5"] != bytes(16) and md5.digest() != streaminfo["md5"]:
+                result["errors"].append("MD5 mismatch")
+
+        loudness = Verifier.loudness_pattern.search(output)
+        peak = Verifier.peak_pattern.search(output)
+        # Silence is stored as None (the loudness is -70 LUFS then, the absolute gate of EBU R128)
+        if loudness is not None and peak is not None:
+            result["integrated_loudness"] = Verifier.parse_level(loudness.group(1), -70.0)
+            result["true_peak"] = Verifier.parse_level(peak.group(1))
+
+        if result["errors"]:
+            result["status"] = "broken"
+        elif streaminfo is not None and _replaygain_tags and result.get("integrated_loudness") is not None \
+                and result["true_peak"] is not None:
+            Verifier.write_replaygain(path, result)
+
+        # After writing the tags, they change the mtime
+        result["key"] = Verifier.stat_key(path)
+        return result
+
+    @staticmethod
+    def parse_level(value: bytes, floor=float("-inf")):
+        level = float(value)
+        return level if level > floor else None
+
+    @staticmethod
+    def stat_key(path: str):
+        try:
+            return Verifier.cache_key(os.stat(path))
+        except OSError:
+            return None
+
+    # Only written in place, a rewritten file would get another size (which --skip-recorded compares)
+    @staticmethod
+    def write_replaygain(path: str, result):
+        tags = [
+            ("REPLAYGAIN_TRACK_GAIN",
+             f"{_replaygain_reference_loudness - result['integrated_loudness']:.2f} dB"),
+            ("REPLAYGAIN_TRACK_PEAK",
+             f"{10 ** (result['true_peak'] / 20):.6f}"),
+        ]
+        try:
+            flac = FlacMetadata(path)
+            vendor, comments = flac.get_vorbis_comment()
+            names = {name for name, _ in tags}
+            kept = [(key, value) for key, value in comments if key.upper() not in names]
+            if kept + tags == comments:
+                return
+
+            flac.set_vorbis_comment(vendor, kept + tags)
+            if not flac.fits_in_place():
+                result["notes"].append("no space for the ReplayGain tags")
+                return
+            flac.save()
+        except (OSError, ValueError) as e:
+            result["notes"].append(f"ReplayGain tags not written: {e}")
+
+
+# Per-track metrics, written as JSON lines to _metrics_file and summed up for the Prometheus text endpoint
+class Metrics:
+    lock = Lock()
+    start_time = time.monotonic()
+    tracks = 0
+    totals = {
+        "bytes_written": 0,
+        "encoder_cpu_seconds": 0.0,
+        "seek_time": 0.0,
+        "post_processing_seconds": 0.0,
+        "signal_to_record_latency": 0.0,
+    }
+    peak_rss = 0
+    trim_verdicts = {}
+
+    @staticmethod
+    def track_finished(ff, fullfilepath: str):
+        try:
+            bytes_written = os.path.getsize(fullfilepath)
+        except OSError:
+            bytes_written = 0
+
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "file": os.path.relpath(fullfilepath, _output_directory),
+            "trackid": ff.trackid,
+            "signal_to_record_latency": ff.metrics.get("signal_to_record_latency"),
+            "seek_time": ff.metrics.get("seek_time"),
+            "encoder_cpu_seconds": ff.metrics.get("encoder_cpu_seconds"),
+            "encoder_peak_rss_bytes": ff.metrics.get("encoder_peak_rss_bytes"),
+            "bytes_written": bytes_written,
+            "post_processing_seconds": ff.metrics.get("post_processing_seconds"),
+            "trim_verdict": ff.trim_verdict,
+        }
+
+        with Metrics.lock:
+            Metrics.tracks += 1
+            for key in Metrics.totals:
+                Metrics.totals[key] += record[key] or 0
+            Metrics.peak_rss = max(
+                Metrics.peak_rss, record["encoder_peak_rss_bytes"] or 0)
+            if ff.trim_verdict is not None:
+                Metrics.trim_verdicts[ff.trim_verdict] = Metrics.trim_verdicts.get(
+                    ff.trim_verdict, 0) + 1
+
+            if _metrics_file is not None:
+                with open(_metrics_file, "a") as fd:
+                    fd.write(json.dumps(record) + "\n")
+
+        log.debug(f"[Metrics] {json.dumps(record)}")
+
+    @staticmethod
+    def prometheus_text():
+        with Metrics.lock:
+            uptime = time.monotonic() - Metrics.start_time
+            lines = [
+                "# TYPE spotrec_tracks_recorded_total counter",
+                f"spotrec_tracks_recorded_total {Metrics.tracks}",
+                "# TYPE spotrec_tracks_per_hour gauge",
+                f"spotrec_tracks_per_hour {Metrics.tracks / uptime * 3600:.3f}",
+                "# TYPE spotrec_bytes_written_total counter",
+                f"spotrec_bytes_written_total {Metrics.totals['bytes_written']}",
+                "# TYPE spotrec_encoder_cpu_seconds_total counter",
+                f"spotrec_encoder_cpu_seconds_total {Metrics.totals['encoder_cpu_seconds']:.3f}",
+                "# TYPE spotrec_encoder_peak_rss_bytes gauge",
+                f"spotrec_encoder_peak_rss_bytes {Metrics.peak_rss}",
+                "# TYPE spotrec_seek_seconds_total counter",
+                f"spotrec_seek_seconds_total {Metrics.totals['seek_time']:.3f}",
+                "# TYPE spotrec_signal_to_record_latency_seconds_total counter",
+                f"spotrec_signal_to_record_latency_seconds_total {Metrics.totals['signal_to_record_latency']:.3f}",
+                "# TYPE spotrec_post_processing_seconds_total counter",
+                f"spotrec_post_processing_seconds_total {Metrics.totals['post_processing_seconds']:.3f}",
+                "# TYPE spotrec_post_processing_queue_depth gauge",
+                f"spotrec_post_processing_queue_depth {PostProcessing.jobs.qsize() if PostProcessing.jobs is not None else 0}",
+                "# TYPE spotrec_trim_verdicts_total counter",
+            ]
+            for verdict, count in sorted(Metrics.trim_verdicts.items()):
+                lines.append(
+                    f'spotrec_trim_verdicts_total{{verdict="{verdict}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def serve(port: int):
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = Metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+        server.daemon_threads = True
+
+        metrics_server_thread = Thread(target=server.serve_forever)
+        metrics_server_thread.daemon = True
+        metrics_server_thread.start()
+
+        log.info(
+            f"[Metrics] Serving metrics on http://127.0.0.1:{port}/metrics")
+
+
+# The jobs of the daemon mode: spotify: URIs which are opened with the MPRIS OpenUri method, one per session at a time
+# A job is done when the player paused at the end of the album or playlist (see Session.finish())
+# Only used in the event loop
+class JobQueue:
+    pending = deque()
+    history = deque(maxlen=_job_history_size)
+    running = True
+    next_id = 1
+
+    # Raises ValueError for invalid jobs
+    @staticmethod
+    def check(uri, player=None):
+        if not isinstance(uri, str) or not uri.startswith("spotify:"):
+            raise ValueError(f"not a spotify: URI: {uri}")
+        if player is not None and not any(session.dbus_dest == player for session in _sessions):
+            raise ValueError(f"unknown player: {player}")
+
+    @staticmethod
+    def add(uri, player=None):
+        JobQueue.check(uri, player)
+
+        job = {"id": JobQueue.next_id, "uri": uri,
+               "player": player, "state": "queued"}
+        JobQueue.next_id += 1
+        JobQueue.pending.append(job)
+        log.info(f"[Jobs] #{job['id']} queued: {uri}")
+        return job
+
+    # Open the next jobs in the sessions which have nothing to do
+    @staticmethod
+    def dispatch():
+        if not JobQueue.running:
+            return
+
+        for session in _sessions:
+            # The next job is tried if the player did not accept a job
+            while session.job is None and not session.stopped:
+                job = next((job for job in JobQueue.pending
+                            if job["player"] in (None, session.dbus_dest)), None)
+                if job is None:
+                    break
+
+                JobQueue.pending.remove(job)
+                job["player"] = session.dbus_dest
+                job["started"] = datetime.datetime.now().isoformat(timespec="seconds")
+                log.info(f"[Jobs] #{job['id']} started on {session.dbus_dest}")
+
+                session.is_script_paused = False
+                if session.spotify.send_dbus_cmd("OpenUri", job["uri"]):
+                    job["state"] = "running"
+                    session.job = job
+                else:
+                    JobQueue.end(job, "failed")
+
+    @staticmethod
+    def end(job, state: str):
+        job["state"] = state
+        job["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+        JobQueue.history.append(job)
+        log.info(f"[Jobs] #{job['id']} {state}")
+
+    @staticmethod
+    def session_finished(session):
+        if session.job is not None:
+            JobQueue.end(session.job, "done")
+            session.job = None
+        JobQueue.dispatch()
+
+    @staticmethod
+    def start():
+        JobQueue.running = True
+        JobQueue.dispatch()
+
+    # Stop recording in all sessions, the pending jobs wait until start()
+    @staticmethod
+    def stop():
+        JobQueue.running = False
+
+        for session in _sessions:
+            if session.stopped:
+                continue
+            session.spotify.stop_recording()
+            if session.job is not None:
+                JobQueue.end(session.job, "stopped")
+                session.job = None
+
+    @staticmethod
+    def status():
+        return {
+            "running": JobQueue.running,
+            "sessions": [{
+                "player": session.dbus_dest,
+                "sink": session.sink_name,
+                "state": session.spotify.playbackstatus,
+                "track": session.spotify.track,
+                "job": session.job["id"] if session.job is not None else None,
+                "stopped": session.stopped,
+            } for session in _sessions],
+            "queue": list(JobQueue.pending),
+            "history": list(JobQueue.history),
+            "tracks_recorded": Metrics.tracks,
+        }
+
+
+# The control socket of the daemon mode (a Unix socket, only accessible by the user)
+# Takes one JSON object per line and answers every one with a JSON object in one line:
+#  {"cmd": "status"}
+#  {"cmd": "queue", "uri": "spotify:playlist:...", "player": "org.mpris.MediaPlayer2.spotify"} ("uris": [...] for several, "player" is optional)
+#  {"cmd": "start"}, {"cmd": "stop"}: start or stop recording (and opening the queued jobs)
+#  {"cmd": "shutdown"}
+# The connections are handled in the event loop, so the commands run between the DBus signals
+class ControlSocket:
+    server = None
+    path = None
+
+    @staticmethod
+    def serve(path: str):
+        # Replace the socket of a daemon which is not running anymore
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                log.error(
+                    f"Error: {app_name} is already running (control socket: {path})")
+                sys.exit(1)
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        server.setblocking(False)
+        ControlSocket.server = server
+        ControlSocket.path = path
+
+        GLib.io_add_watch(server.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN, ControlSocket.on_connect)
+
+        log.info(f"[Control] Listening on {path}")
+
+    @staticmethod
+    def close():
+        if ControlSocket.server is None:
+            return
+        ControlSocket.server.close()
+        ControlSocket.server = None
+        try:
+            os.unlink(ControlSocket.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def on_connect(fd, condition):
+        try:
+            connection, _ = ControlSocket.server.accept()
+        except BlockingIOError:
+            return True
+        connection.setblocking(False)
+        request = bytearray()
+
+        def reply(line: bytes):
+            response = ControlSocket.handle(line)
+            connection.sendall((json.dumps(response) + "\n").encode("utf-8"))
+
+        def on_data(fd, condition):
+            try:
+                data = connection.recv(4096)
+            except BlockingIOError:
+                return True
+            except OSError:
+                data = b""
+
+            try:
+                if not data:
+                    # A last request without a newline
+                    if request.strip():
+                        reply(bytes(request))
+                    connection.close()
+                    return False
+
+                request.extend(data)
+                while b"\n" in request:
+                    end = request.index(b"\n")
+                    line = bytes(request[:end])
+                    del request[:end + 1]
+                    if line.strip():
+                        reply(line)
+
+                if len(request) > _control_max_request_bytes:
+                    connection.close()
+                    return False
+            except OSError:
+                # The client is gone
+                connection.close()
+                return False
+            return True
+
+        GLib.io_add_watch(connection.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, on_data)
+        return True
+
+    @staticmethod
+    def handle(line: bytes):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"ok": False, "error": "invalid JSON"}
+        cmd = request.get("cmd") if isinstance(request, dict) else None
+        log.debug(f"[Control] {cmd}")
+
+        if cmd == "status":
+            return {"ok": True, **JobQueue.status()}
+
+        if cmd == "queue":
+            uris = request.get("uris", [request.get("uri")])
+            if not isinstance(uris, list) or not uris:
+                return {"ok": False, "error": "no uris"}
+            player = request.get("player")
+            try:
+                # Check all before the first is queued
+                for uri in uris:
+                    JobQueue.check(uri, player)
+            except ValueError as e:
+                return {"ok": False, "error": str(e)}
+            jobs = [JobQueue.add(uri, player) for uri in uris]
+            JobQueue.dispatch()
+            return {"ok": True, "jobs": jobs}
+
+        if cmd == "start":
+            JobQueue.start()
+            return {"ok": True}
+
+        if cmd == "stop":
+            JobQueue.stop()
+            return {"ok": True}
+
+        if cmd == "shutdown":
+            # After the answer was sent
+            GLib.idle_add(doExit)
+            return {"ok": True}
+
+        return {"ok": False, "error": f"unknown cmd: {cmd}"}
+
+
+# Derives the waiting times from measurements of this session instead of the fixed defaults:
+#  "first_packet": time from starting FFmpeg until it received the first audio
+#  "dbus": round-trip time of the commands sent to Spotify
+#  "stop": time FFmpeg needs to exit after it was terminated
+# Until enough samples were measured (or without --adaptive-timing) the defaults are used
+class TimingController:
+    samples = {"first_packet": [], "dbus": [], "stop": []}
+    decisions = {}
+    lock = Lock()
+
+    @staticmethod
+    def add_sample(kind: str, seconds: float):
+        with TimingController.lock:
+            TimingController.samples[kind].append(seconds)
+
+    # Returns the 95th percentile or None if there are not enough samples
+    @staticmethod
+    def p95(kind: str):
+        with TimingController.lock:
+            samples = list(TimingController.samples[kind])
+        if not _adaptive_timing or len(samples) < _adaptive_timing_min_samples:
+            return None
+        return percentile(samples, 95)
+
+    # Log every change of a waiting time, so the clipping risk can be compared with the time saved
+    @staticmethod
+    def decide(name: str, value: float, default: float, reason: str):
+        value = round(value, 2)
+        if TimingController.decisions.get(name) != value:
+            TimingController.decisions[name] = value
+            log.info(
+                f"[Timing] {name}: {value:.2f} s (default {default:.2f} s, {reason})")
+        return value
+
+    # FFmpeg has to receive audio before the song starts playing
+    @staticmethod
+    def recording_time_before_song():
+        first_packet = TimingController.p95("first_packet")
+        if first_packet is None:
+            return _recording_time_before_song
+        return TimingController.decide("recording time before song", min(max(first_packet + 0.05, 0.05), 2.0),
+                                       _recording_time_before_song, f"p95 first packet {first_packet * 1000:.0f} ms")
+
+    # The track change signal arrives late by about one DBus round-trip, plus the 50 ms capture latency
+    @staticmethod
+    def recording_time_after_song():
+        dbus_rtt = TimingController.p95("dbus")
+        if dbus_rtt is None:
+            return _recording_time_after_song
+        return TimingController.decide("recording time after song", min(0.05 + 2 * dbus_rtt + 0.25, _recording_time_after_song),
+                                       _recording_time_after_song, f"p95 DBus round-trip {dbus_rtt * 1000:.0f} ms")
+
+    # Spotify has to be past its restart threshold when Previous is sent (Pause and Previous take one round-trip each)
+    @staticmethod
+    def playback_time_before_seeking_to_beginning():
+        dbus_rtt = TimingController.p95("dbus")
+        if dbus_rtt is None:
+            return _playback_time_before_seeking_to_beginning
+        return TimingController.decide("playback time before seeking",
+                                       min(_spotify_previous_restart_threshold +
+                                           2 * dbus_rtt + 0.5, _playback_time_before_seeking_to_beginning),
+                                       _playback_time_before_seeking_to_beginning, f"p95 DBus round-trip {dbus_rtt * 1000:.0f} ms")
+
+    # How long to wait for FFmpeg to exit before it is killed (killing loses the track)
+    @staticmethod
+    def ffmpeg_stop_timeout():
+        stop = TimingController.p95("stop")
+        if stop is None:
+            return _ffmpeg_stop_timeout
+        return TimingController.decide("FFmpeg stop timeout", min(max(2 * stop, _ffmpeg_stop_timeout), max(5.0, _ffmpeg_stop_timeout)),
+                                       _ffmpeg_stop_timeout, f"p95 FFmpeg stop {stop * 1000:.0f} ms")
+
+    @staticmethod
+    def log_summary():
+        with TimingController.lock:
+            samples = {kind: list(values)
+                       for kind, values in TimingController.samples.items()}
+        for kind, values in samples.items():
+            if values:
+                log.info(f"[Timing] {kind}: {len(values)} samples, "
+                         f"median {percentile(values, 50) * 1000:.0f} ms, p95 {percentile(values, 95) * 1000:.0f} ms")
+
+
+# Runs the post-processing jobs on a fixed number of low priority worker threads
+# The queue is bounded: submit() from other threads (encoders, the mover) blocks (backpressure) if post-processing
+# can't keep up. The main loop must never block, its jobs (one per track recorded by FFmpeg) are kept in an unbounded
+# list instead and added when the queue has room again, so this path has no backpressure. A job is a few small objects,
+# the files wait on disk either way.
+class PostProcessing:
+    jobs = None
+    workers = []
+    # Jobs submitted from the main loop while the queue was full (only used by the main thread)
+    deferred = deque()
+    retry_scheduled = False
+
+    @staticmethod
+    def start():
+        PostProcessing.jobs = queue.Queue(_post_processing_queue_size)
+
+        class PostProcessingWorkerThread(Thread):
+            def __init__(self):
+                Thread.__init__(self)
+                self.daemon = True
+
+            def run(self):
+                PostProcessing.lower_priority()
+
+                while True:
+                    description, func, args = PostProcessing.jobs.get()
+                    start = time.perf_counter()
+                    try:
+                        func(*args)
+                        log.debug(
+                            f"[PostProcessing] Finished {description} in {time.perf_counter() - start:.2f} s")
+                    except Exception:
+                        log.warning(
+                            f"[PostProcessing] Failed {description}:\n{traceback.format_exc()}")
+                    finally:
+                        PostProcessing.jobs.task_done()
+
+        for _ in range(_post_processing_workers):
+            worker = PostProcessingWorkerThread()
+            worker.start()
+            PostProcessing.workers.append(worker)
+
+    # Set nice and ionice of the calling worker thread (Linux applies both per thread, FFmpeg children inherit them)
+    @staticmethod
+    def lower_priority():
+        tid = get_native_id()
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, _post_processing_niceness)
+        except OSError:
+            log.debug("[PostProcessing] Failed to set niceness")
+        # Class 3: idle, only get disk time when no one else needs it
+        try:
+            Shell.run(["ionice", "-c", "3", "-p", str(tid)])
+        except OSError:
+            log.debug("[PostProcessing] Failed to set ionice (is util-linux installed?)")
+
+    @staticmethod
+    def submit(description: str, func, *args):
+        if PostProcessing.jobs.full():
+            log.warning(
+                f"[PostProcessing] Queue full ({PostProcessing.depth()} jobs), post-processing falls behind")
+
+        if current_thread() is not main_thread():
+            # Other threads (encoders, the mover) wait for a free slot
+            PostProcessing.jobs.put((description, func, args))
+        elif PostProcessing.deferred or not PostProcessing.put_nowait((description, func, args)):
+            # Never block the main loop, keep the job (in order) until the queue has room again
+            PostProcessing.deferred.append((description, func, args))
+            if not PostProcessing.retry_scheduled:
+                PostProcessing.retry_scheduled = True
+                GLib.timeout_add(_post_processing_retry_ms,
+                                 PostProcessing.retry_deferred)
+            log.info(
+                f"[PostProcessing] Deferred {description} (queue depth: {PostProcessing.depth()}, "
+                f"{len(PostProcessing.deferred)} deferred)")
+            return
+
+        log.info(
+            f"[PostProcessing] Queued {description} (queue depth: {PostProcessing.depth()})")
+
+    # Jobs waiting in the queue and in the deferred list
+    @staticmethod
+    def depth():
+        return PostProcessing.jobs.qsize() + len(PostProcessing.deferred)
+
+    @staticmethod
+    def put_nowait(job):
+        try:
+            PostProcessing.jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            return False
+
+    # GLib timeout callback: moves the deferred jobs into the queue, returns True to be called again
+    @staticmethod
+    def retry_deferred():
+        while PostProcessing.deferred:
+            if not PostProcessing.put_nowait(PostProcessing.deferred[0]):
+                return True
+            description = PostProcessing.deferred.popleft()[0]
+            log.info(
+                f"[PostProcessing] Queued {description} (queue depth: {PostProcessing.depth()})")
+
+        PostProcessing.retry_scheduled = False
+        return False
+
+    @staticmethod
+    def stop():
+        if PostProcessing.jobs is None:
+            return
+
+        # The main loop has stopped, the deferred jobs can wait for the queue now
+        while PostProcessing.deferred:
+            PostProcessing.jobs.put(PostProcessing.deferred.popleft())
+
+        if PostProcessing.jobs.unfinished_tasks:
+            log.info(
+                f"[PostProcessing] Waiting for {PostProcessing.jobs.unfinished_tasks} jobs to finish")
+        PostProcessing.jobs.join()
+
+
+# Moves the finished files from the staging directory (--staging-directory) into the output directory
+# One thread copies one file after another, so the (slow) output disk only gets sequential writes
+# and nothing of the recording waits for it. The recording is paused while the output directory is full.
+class Mover:
+    jobs = None
+    thread = None
+    stopping = Event()
+    # Temporary files of the post-processing (cover art, trimming), they are never moved
+    temp_suffixes = ("_withArtwork", "_trimmed")
+
+    @staticmethod
+    def start():
+        Mover.jobs = queue.Queue()
+
+        class MoverThread(Thread):
+            def __init__(self):
+                Thread.__init__(self)
+                self.daemon = True
+
+            def run(self):
+                PostProcessing.lower_priority()
+
+                while True:
+                    job = Mover.jobs.get()
+                    try:
+                        if job is None:
+                            return
+                        Mover.move(*job)
+                    except Exception:
+                        log.warning(
+                            f"[Mover] Failed moving {job[0]}:\n{traceback.format_exc()}")
+                    finally:
+                        Mover.jobs.task_done()
+
+        Mover.thread = MoverThread()
+        Mover.thread.start()
+
+        # Files which were finished but not moved in the last run
+        for fullfilepath in Verifier.find_files(_staging_directory):
+            if not os.path.splitext(fullfilepath)[0].endswith(Mover.temp_suffixes):
+                Mover.submit(fullfilepath)
+
+    # Hidden file next to a staged file, with what is needed to index it if it is moved after a restart
+    @staticmethod
+    def info_path(fullfilepath: str):
+        return os.path.join(os.path.dirname(fullfilepath), "." + os.path.basename(fullfilepath) + ".json")
+
+    @staticmethod
+    def submit(fullfilepath: str, ff=None):
+        if ff is not None and ff.trackid is not None and _skip_recorded:
+            with open(Mover.info_path(fullfilepath), "w") as fd:
+                json.dump({"trackid": ff.trackid,
+                           "expected_length": ff.expected_length}, fd)
+
+        Mover.jobs.put((fullfilepath, ff))
+        log.debug(
+            f"[Mover] Queued {os.path.basename(fullfilepath)} (queue depth: {Mover.jobs.qsize()})")
+
+    # Runs in the mover thread
+    @staticmethod
+    def move(fullfilepath: str, ff):
+        target = os.path.join(_output_directory,
+                              os.path.relpath(fullfilepath, _staging_directory))
+        target_dir = os.path.dirname(target)
+        Path(target_dir).mkdir(parents=True, exist_ok=True)
+
+        if not Mover.wait_for_space(target_dir, os.path.getsize(fullfilepath)):
+            log.info(
+                f"[Mover] {os.path.basename(fullfilepath)} stays in the staging directory")
+            return
+
+        # Copied under a hidden name first, so the output directory never has an incomplete file
+        start = time.perf_counter()
+        tmp_file = os.path.join(target_dir, "." + os.path.basename(target) + ".part")
+        try:
+            sha256 = Mover.copy_file(fullfilepath, tmp_file)
+            target = FilenameTemplate.unique_path(target)
+            os.replace(tmp_file, target)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        os.remove(fullfilepath)
+        log.debug(
+            f"[Mover] Moved {os.path.basename(target)} in {time.perf_counter() - start:.2f} s")
+
+        info_file = Mover.info_path(fullfilepath)
+        if ff is not None:
+            ff.delivered(target, sha256)
+        elif _skip_recorded and os.path.exists(info_file):
+            # A file from the last run
+            with open(info_file) as fd:
+                info = json.load(fd)
+            RecordingIndex.add(info["trackid"], target,
+                               FFmpeg.get_duration(target, info["expected_length"]), sha256)
+        if os.path.exists(info_file):
+            os.remove(info_file)
+
+    # Copies the file and returns its sha256 (if --skip-recorded is set, otherwise None)
+    # The digest is computed from the staged file while copying, so the (slow) output disk is not read again
+    @staticmethod
+    def copy_file(src: str, dst: str):
+        if not _skip_recorded:
+            shutil.copyfile(src, dst)
+            return None
+
+        sha256 = hashlib.sha256()
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            for block in iter(lambda: fsrc.read(1024 * 1024), b""):
+                sha256.update(block)
+                fdst.write(block)
+        return sha256.hexdigest()
+
+    # Waits until the output directory has space for the file (plus --min-free-space)
+    # Returns False if SpotRec is shutting down
+    @staticmethod
+    def wait_for_space(directory: str, size: int):
+        needed = size + _min_free_space * 1024 * 1024
+        paused = False
+        while shutil.disk_usage(directory).free < needed:
+            if not paused:
+                log.warning(
+                    f"[Mover] Less than {_min_free_space} MiB free in the output directory, pausing the recording")
+                GLib.idle_add(Mover.pause_recording)
+                paused = True
+            if Mover.stopping.wait(_mover_retry_seconds):
+                return False
+
+        if paused:
+            log.info("[Mover] Enough free space again, resuming the recording")
+            GLib.idle_add(Mover.resume_recording)
+        return True
+
+    # Runs in the event loop
+    @staticmethod
+    def pause_recording():
+        for session in _sessions:
+            if not session.stopped and session.spotify.is_playing():
+                # The current track is recorded again from the beginning when resuming
+                session.spotify.stop_recording()
+                session.paused_by_mover = True
+        return False
+
+    # Runs in the event loop
+    @staticmethod
+    def resume_recording():
+        for session in _sessions:
+            if session.paused_by_mover and not session.stopped:
+                session.paused_by_mover = False
+                session.spotify.send_dbus_cmd("Play")
+                session.spotify.start_record()
+        return False
+
+    @staticmethod
+    def stop():
+        if Mover.jobs is None:
+            return
+
+        # A full output directory is not waited for
+        Mover.stopping.set()
+        if Mover.jobs.unfinished_tasks:
+            log.info(
+                f"[Mover] Moving {Mover.jobs.unfinished_tasks} files to the output directory")
+        Mover.jobs.put(None)
+        Mover.thread.join()
+
+
+class RingBuffer:
+    # Fixed size buffer for raw PCM, positions are absolute byte offsets since the start of the capture
+    # The capture reads directly into the buffer and the encoders write views of it, so the audio is not copied in Python
+    def __init__(self, size: int):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.write_pos = 0
+        # Bytes after write_pos which are being overwritten by the capture
+        self.reserved = 0
+        self.closed = False
+        self.condition = Condition()
+
+    # Returns a view of the space after the write position (at most max_length bytes, up to the end of the buffer)
+    # The old data in it is given up until commit() is called with the number of bytes that were written into it
+    def reserve(self, max_length: int):
+        with self.condition:
+            offset = self.write_pos % self.size
+            self.reserved = min(max_length, self.size - offset)
+            return self.view[offset:offset + self.reserved]
+
+    def commit(self, length: int):
+        with self.condition:
+            self.write_pos += length
+            self.reserved = 0
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def oldest_pos(self):
+        return max(0, self.write_pos + self.reserved - self.size)
+
+    # Views of the data (two if it wraps around the end of the buffer)
+    # They stay valid only as long as pos is not older than oldest_pos()
+    def views(self, pos: int, length: int):
+        offset = pos % self.size
+        first = min(length, self.size - offset)
+        views = [self.view[offset:offset + first]]
+        if first < length:
+            views.append(self.view[0:length - first])
+        return views
+
+
+# Feeds the audio of one track from the capture buffer into its own encoder
+class TrackEncoder(Thread):
+    def __init__(self, buffer: RingBuffer, start_pos: int, ffmpeg, expected_length=None, holdback=0):
+        Thread.__init__(self)
+        self.buffer = buffer
+        self.start_pos = start_pos
+        self.pos = start_pos
+        self.expected_length = expected_length
+        # Bytes behind the capture which are not encoded until the end is known
+        self.holdback = holdback
+        self.end_pos = None
+        self.ffmpeg = ffmpeg
+        self.aborted = False
+
+    def end(self, end_pos: int):
+        with self.buffer.condition:
+            if end_pos < self.pos and not self.aborted:
+                log.warning(
+                    f"[FFmpeg] [{self.ffmpeg.pid}] Cut point {self.pos_to_seconds(self.pos - end_pos):.2f} s behind the encoded audio")
+            self.end_pos = max(end_pos, self.start_pos)
+            self.buffer.condition.notify_all()
+
+        # Compare the length of the cut with the length reported by Spotify
+        if self.expected_length and not self.aborted:
+            length = self.pos_to_seconds(self.end_pos - self.start_pos)
+            if abs(length - self.expected_length) > _gapless_length_tolerance:
+                log.warning(
+                    f"[FFmpeg] [{self.ffmpeg.pid}] Track boundary not trusted: recorded {length:.2f} s, expected {self.expected_length:.2f} s")
+
+    def abort(self):
+        self.aborted = True
+        self.end(self.pos)
+
+    def run(self):
+        for attempt in range(_encoder_attempts):
+            self.feed()
+
+            if self.aborted:
+                self.ffmpeg.process.kill()
+                self.ffmpeg.wait()
+                self.ffmpeg.process = None
+                self.ffmpeg.remove_file()
+                log.info(f"[FFmpeg] [{self.ffmpeg.pid}] killed")
+                return
+
+            if self.ffmpeg.finish_encoding():
+                return
+
+            # Encode the track again while its audio is still in the capture buffer
+            if self.buffer.oldest_pos() > self.start_pos or attempt + 1 == _encoder_attempts:
+                break
+            self.ffmpeg.remove_file()
+            self.ffmpeg = self.ffmpeg.encode_again()
+            self.pos = self.start_pos
+            log.info(
+                f"[FFmpeg] [{self.ffmpeg.pid}] Encoding the track again from the capture buffer")
+
+        # Keep what was encoded
+        self.ffmpeg.post_process(clean=False)
+
+    # Block until there is audio to encode (or the buffer is closed), returns the current write position
+    # While the end is not known, only audio older than the holdback is encoded
+    def wait_for_audio(self, timeout):
+        with self.buffer.condition:
+            self.buffer.condition.wait_for(
+                lambda: self.buffer.write_pos > self.pos + (self.holdback if self.end_pos is None else 0)
+                or self.buffer.closed, timeout)
+            return self.buffer.write_pos
+
+    # Writes the audio from the start to the end position into the encoder
+    def feed(self):
+        try:
+            while not self.aborted:
+                write_pos = self.wait_for_audio(1)
+
+                # The encoder fell behind and the audio was already overwritten
+                if self.pos < self.buffer.oldest_pos():
+                    log.warning(
+                        f"[FFmpeg] [{self.ffmpeg.pid}] Encoder too slow, lost {self.pos_to_seconds(self.buffer.oldest_pos() - self.pos):.2f} s of audio")
+                    self.pos = self.buffer.oldest_pos()
+
+                available = write_pos - self.pos
+                if self.end_pos is not None:
+                    available = min(available, self.end_pos - self.pos)
+                elif not self.buffer.closed:
+                    available -= self.holdback
+                if available > 0:
+                    for view in self.buffer.views(self.pos, available):
+                        self.ffmpeg.process.stdin.write(view)
+
+                    # The capture overwrote the audio while it was written
+                    if self.pos < self.buffer.oldest_pos():
+                        log.warning(
+                            f"[FFmpeg] [{self.ffmpeg.pid}] Encoder too slow, audio was overwritten while encoding")
+                    self.pos += available
+
+                if self.end_pos is not None and self.pos >= self.end_pos:
+                    break
+                if self.buffer.closed and self.pos >= self.buffer.write_pos:
+                    break
+        except (BrokenPipeError, ValueError):
+            log.warning(f"[FFmpeg] [{self.ffmpeg.pid}] Encoder closed early")
+
+    @staticmethod
+    def pos_to_seconds(pos: int):
+        return pos / (_pcm_sample_rate * _pcm_channels * _pcm_sample_width)
+
+
+# Captures the recording sink with one long-running process (parec or FFmpeg) into a ring buffer
+# Track changes only set cut points, every track is encoded by its own (short-lived) encoder from the buffer
+class ContinuousCapture:
+    read_size = 8820  # 50 ms
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.frame_size = _pcm_channels * _pcm_sample_width
+        self.bytes_per_second = _pcm_sample_rate * self.frame_size
+        self.buffer = RingBuffer(
+            _capture_buffer_seconds * self.bytes_per_second)
+        self.encoders = []
+        self.current = None
+        self.process = None
+        self.last_write_time = time.monotonic()
+
+    def start(self):
+        monitor = self.session.sink_name + '.monitor'
+        if _capture_backend == "parec":
+            self.process = Shell.Popen(['parec', '--raw', '--device=' + monitor, '--format=s16le',
+                                        '--rate=' + str(_pcm_sample_rate), '--channels=' + str(_pcm_channels),
+                                        '--latency-msec=50'],
+                                       stdout=subprocess.PIPE)
+        else:
+            self.process = Shell.Popen([_ffmpeg_executable, '-hide_banner',
+                                        '-f', 'pulse', '-ac', str(_pcm_channels), '-ar', str(_pcm_sample_rate), '-fragment_size', '8820',
+                                        '-i', monitor,
+                                        '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:1'],
+                                       stdout=subprocess.PIPE)
+
+        class CaptureReaderThread(Thread):
+            def __init__(self, parent):
+                Thread.__init__(self)
+                self.parent = parent
+
+            def run(self):
+                # Read from the pipe straight into the ring buffer (one read() per chunk, no copies)
+                stdout = self.parent.process.stdout.raw
+                buffer = self.parent.buffer
+                while True:
+                    length = stdout.readinto(buffer.reserve(self.parent.read_size))
+                    if not length:
+                        break
+                    buffer.commit(length)
+                    self.parent.last_write_time = time.monotonic()
+                buffer.commit(0)
+                buffer.close()
+                log.info(f"[{app_name}] Capture stopped")
+
+        capture_reader_thread = CaptureReaderThread(self)
+        capture_reader_thread.start()
+
+        log.info(
+            f"[{app_name}] [{self.process.pid}] Capture started ({_capture_backend})")
+
+    # Convert seconds to a byte count, aligned to whole audio frames
+    def seconds_to_bytes(self, seconds: float):
+        return int(seconds * _pcm_sample_rate) * self.frame_size
+
+    # Buffer position of the audio that was captured at the given time.monotonic() time
+    def position_at(self, t: float):
+        with self.buffer.condition:
+            pos = self.buffer.write_pos
+            written = self.last_write_time
+        return max(self.buffer.oldest_pos(), pos + self.seconds_to_bytes(t - written))
+
+    def start_track(self, out_dir: str, file: str, metadata_for_file={}, start_pos=None, expected_length=None,
+                    min_start_pos=None):
+        if start_pos is None:
+            # Start a little before the current position to not miss something
+            start_pos = self.buffer.write_pos - \
+                self.seconds_to_bytes(
+                    TimingController.recording_time_before_song())
+            # But not before the pause (that is the audio from before seeking to the beginning)
+            if min_start_pos is not None:
+                start_pos = max(min_start_pos, start_pos)
+        start_pos = max(self.buffer.oldest_pos(), start_pos)
+
+        ff = FFmpeg(self.session)
+        ff.encode(out_dir, file, metadata_for_file)
+
+        # Gapless cut points are set late, in the past
+        holdback = self.seconds_to_bytes(_gapless_holdback) if _gapless else 0
+        encoder = TrackEncoder(self.buffer, start_pos, ff, expected_length, holdback)
+        self.encoders.append(encoder)
+        self.current = encoder
+        encoder.start()
+
+        return ff
+
+    def end_track(self, end_pos=None):
+        if self.current is None:
+            return
+
+        if end_pos is None:
+            # Record a little longer to not miss something
+            end_pos = self.buffer.write_pos + \
+                self.seconds_to_bytes(
+                    TimingController.recording_time_after_song())
+        self.current.end(end_pos)
+        self.current = None
+
+        self.encoders = [e for e in self.encoders if e.is_alive()]
+
+    # Discard the current track
+    def abort_track(self):
+        if self.current is None:
+            return
+
+        self.current.abort()
+        self.current = None
+
+    def stop(self):
+        # Unfinished tracks are discarded like with the per-track FFmpeg recording
+        for encoder in self.encoders:
+            encoder.abort()
+        self.encoders = []
+        self.current = None
+
+        if self.process is not None:
+            self.process.terminate()
+            self.process = None
+
+
+# Processes are started directly from an argument list (no shell in between, so signals reach them)
+# Every process gets its own process group, so a Ctrl^C in the terminal only reaches SpotRec,
+# which then stops them in the right order
+class Shell:
+    devnull = None
+
+    @staticmethod
+    def get_devnull():
+        # One handle for all processes instead of opening /dev/null for every call
+        if Shell.devnull is None:
+            Shell.devnull = open(os.devnull, "r+b")
+        return Shell.devnull
+
+    @staticmethod
+    def get_env(c_locale: bool):
+        # The output of pactl is parsed, so it must not be translated
+        if c_locale:
+            return dict(os.environ, LC_ALL="C")
+        return None
+
+    @staticmethod
+    def run(args, c_locale=False):
+        # 'run()' waits until the process is done
+        log.debug(f"[Shell] run: {shlex.join(args)}")
+        output = None if _debug_logging else Shell.get_devnull()
+        return subprocess.run(args, stdin=Shell.get_devnull(), stdout=output, stderr=output,
+                              env=Shell.get_env(c_locale), start_new_session=True)
+
+    @staticmethod
+    def Popen(args, stdin=None, stdout=None, stderr=None, c_locale=False):
+        # 'Popen()' continues running in the background
+        # If stdin or stdout is a pipe, it is opened in binary mode
+        log.debug(f"[Shell] Popen: {shlex.join(args)}")
+        output = None if _debug_logging else Shell.get_devnull()
+        return subprocess.Popen(args, stdin=stdin if stdin is not None else Shell.get_devnull(),
+                                stdout=stdout if stdout is not None else output,
+                                stderr=stderr if stderr is not None else output,
+                                env=Shell.get_env(c_locale), start_new_session=True)
+
+    @staticmethod
+    def check_output(args, c_locale=False):
+        log.debug(f"[Shell] check_output: {shlex.join(args)}")
+        out = subprocess.check_output(args, stdin=Shell.get_devnull(), env=Shell.get_env(c_locale),
+                                      start_new_session=True, encoding=_shell_encoding)
+        return out.rstrip('\n')
+
+    # Returns a file descriptor which becomes readable when the process exits (or None if the kernel can't do this)
+    @staticmethod
+    def pidfd_open(pid: int):
+        try:
+            return os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            return None
+
+    # Sleeps until the process exited or the timeout expired (without reaping the process)
+    @staticmethod
+    def wait_exit(pid: int, timeout=None):
+        fd = Shell.pidfd_open(pid)
+        if fd is None:
+            time.sleep(0.01 if timeout is None else min(0.01, timeout))
+            return
+        try:
+            select.select([fd], [], [], timeout)
+        finally:
+            os.close(fd)
+
+
+# Persistent connection to the PulseAudio/PipeWire server (libpulse through the 'pulsectl' module)
+class PulseClient:
+    def __init__(self):
+        # pulsectl connections are not thread-safe, so one is used for commands and one only for events
+        self.pulse = pulsectl.Pulse(app_name)
+        self.lock = Lock()
+        self.events = pulsectl.Pulse(app_name + "-events")
+        self.event_callbacks = []
+
+        # Sink inputs seen by the event listener (index -> (application name, process id))
+        self.sink_inputs = {}
+        for sink_input in self.pulse.sink_input_list():
+            self.sink_inputs[sink_input.index] = self.get_application(
+                sink_input)
+
+        class PulseEventThread(Thread):
+            def __init__(self, parent):
+                Thread.__init__(self)
+                self.parent = parent
+
+            def run(self):
+                self.parent.events.event_mask_set('sink_input')
+                self.parent.events.event_callback_set(
+                    self.parent.on_event)
+                try:
+                    self.parent.events.event_listen()
+                except pulsectl.PulseError:
+                    pass
+                log.debug(f"[{app_name}] Pulse event listener stopped")
+
+        pulse_event_thread = PulseEventThread(self)
+        pulse_event_thread.daemon = True
+        pulse_event_thread.start()
+
+    @staticmethod
+    def get_application(sink_input):
+        name = sink_input.proplist.get("application.name", "").lower()
+        try:
+            pid = int(sink_input.proplist.get("application.process.id"))
+        except (TypeError, ValueError):
+            pid = None
+        return name, pid
+
+    # Called by the event listener, no requests are allowed on self.events here
+    def on_event(self, event):
+        if event.t == 'new':
+            event_type = 'new'
+            with self.lock:
+                try:
+                    self.sink_inputs[event.index] = self.get_application(
+                        self.pulse.sink_input_info(event.index))
+                except pulsectl.PulseError:
+                    return
+        elif event.t == 'remove':
+            event_type = 'remove'
+            self.sink_inputs.pop(event.index, None)
+        else:
+            return
+
+        for callback in list(self.event_callbacks):
+            callback(event_type, event.index)
+
+    def load_module(self, name: str, args: str):
+        with self.lock:
+            return str(self.pulse.module_load(name, args))
+
+    def unload_module(self, index: str):
+        with self.lock:
+            self.pulse.module_unload(int(index))
+
+    def move_sink_input(self, index: int, sink_name: str):
+        with self.lock:
+            try:
+                sink = self.pulse.get_sink_by_name(sink_name)
+                self.pulse.sink_input_move(index, sink.index)
+                return True
+            except pulsectl.PulseError:
+                return False
+
+    def set_sink_input_volume(self, index: int, volume: float):
+        with self.lock:
+            try:
+                self.pulse.volume_set_all_chans(
+                    self.pulse.sink_input_info(index), volume)
+            except pulsectl.PulseError:
+                log.warning(
+                    f"[{app_name}] Failed to set the volume of sink input {index}")
+
+    def set_sink_volume(self, sink_name: str, volume: float):
+        with self.lock:
+            try:
+                self.pulse.volume_set_all_chans(
+                    self.pulse.get_sink_by_name(sink_name), volume)
+            except pulsectl.PulseError:
+                log.warning(
+                    f"[{app_name}] Failed to set the volume of sink {sink_name}")
+
+    def close(self):
+        self.events.event_listen_stop()
+        with self.lock:
+            self.pulse.close()
+
+
+# Keeps Spotify routed to the recording sink of a session, also when Spotify recreates its stream (after ads, device changes, ...)
+# Reacts to sink-input events from the native client or from "pactl subscribe"
+class SinkInputWatcher(Thread):
+    # Line of "pactl subscribe", e.g. Event 'new' on sink-input #42
+    pactl_event_pattern = re.compile(rb"^Event '(\w+)' on sink-input #(\d+)$")
+
+    def __init__(self, session):
+        Thread.__init__(self)
+        self.daemon = True
+        self.session = session
+        self.events = queue.Queue()
+        self.process = None
+        # Time when the Spotify stream disappeared
+        self.lost_time = None
+
+    def start(self):
+        if PulseAudio.client is not None:
+            PulseAudio.client.event_callbacks.append(self.on_event)
+        else:
+            self.process = Shell.Popen(
+                ["pactl", "subscribe"], stdout=subprocess.PIPE, c_locale=True)
+
+            class PactlSubscribeThread(Thread):
+                def __init__(self, parent):
+                    Thread.__init__(self)
+                    self.daemon = True
+                    self.parent = parent
+
+                def run(self):
+                    for line in self.parent.process.stdout:
+                        match = SinkInputWatcher.pactl_event_pattern.match(line.strip())
+                        if match:
+                            self.parent.on_event(
+                                match.group(1).decode(), int(match.group(2)))
+
+            pactl_subscribe_thread = PactlSubscribeThread(self)
+            pactl_subscribe_thread.start()
+
+        Thread.start(self)
+
+    def on_event(self, event_type: str, index: int):
+        if event_type in ('new', 'remove'):
+            self.events.put((event_type, index))
+
+    def request_move(self):
+        self.events.put(('move', self.session.spotify_sink_input_id))
+
+    def stop(self):
+        self.events.put((None, -1))
+        if PulseAudio.client is not None and self.on_event in PulseAudio.client.event_callbacks:
+            PulseAudio.client.event_callbacks.remove(self.on_event)
+        if self.process is not None:
+            self.process.terminate()
+            self.process = None
+
+    def run(self):
+        session = self.session
+
+        while True:
+            event_type, index = self.events.get()
+
+            if event_type is None:
+                break
+
+            if event_type == 'move':
+                PulseAudio.move_spotify_to_own_sink(session)
+
+            elif event_type == 'remove':
+                if index == session.spotify_sink_input_id:
+                    session.spotify_sink_input_id = -1
+                    self.lost_time = time.monotonic()
+                    log.info(
+                        f"[{app_name}] Spotify stream of {session.dbus_dest} removed")
+
+            elif event_type == 'new':
+                # Spotify is moved for the first time when it starts playing
+                if session.is_first_playing or index == session.spotify_sink_input_id:
+                    continue
+
+                if not PulseAudio.is_spotify_sink_input(session, index):
+                    continue
+
+                log.info(
+                    f"[{app_name}] New Spotify stream #{index} for {session.dbus_dest}")
+                session.spotify_sink_input_id = index
+                PulseAudio.set_sink_volumes_to_100(session)
+
+                if PulseAudio.move_spotify_to_own_sink(session):
+                    if self.lost_time is not None:
+                        gap = time.monotonic() - self.lost_time
+                        log.info(
+                            f"[{app_name}] Spotify was not routed to own sink for {gap * 1000:.0f} ms")
+                    self.lost_time = None
+
+
+class PulseAudio:
+    client = None
+    spotify_application_name = "spotify"
+
+    @staticmethod
+    def connect():
+        if pulsectl is None:
+            log.error(
+                "Error: The 'pulsectl' python module is needed for the native PulseAudio client.")
+            sys.exit(1)
+
+        PulseAudio.client = PulseClient()
+        log.info(f"[{app_name}] Connected to the pulse server")
+
+    @staticmethod
+    def disconnect():
+        if PulseAudio.client is not None:
+            PulseAudio.client.close()
+            PulseAudio.client = None
+
+    @staticmethod
+    def load_sink(session):
+        log.info(f"[{app_name}] Creating pulse sink {session.sink_name}")
+
+        if _mute_pa_recording_sink:
+            module = 'module-null-sink'
+            args = 'sink_name="' + session.sink_name + \
+                '" sink_properties=device.description="' + \
+                session.sink_name + '" rate=44100 channels=2'
+        else:
+            module = 'module-remap-sink'
+            args = 'sink_name="' + session.sink_name + \
+                '" sink_properties=device.description="' + \
+                session.sink_name + '" rate=44100 channels=2 remix=no'
+            # To use another master sink where to play:
+            # pactl load-module module-remap-sink sink_name=spotrec sink_properties=device.description="spotrec" master=MASTER_SINK_NAME channels=2 remix=no
+
+        if PulseAudio.client is not None:
+            session.sink_id = PulseAudio.client.load_module(module, args)
+        else:
+            session.sink_id = Shell.check_output(
+                ['pactl', 'load-module', module, args])
+
+    @staticmethod
+    def unload_sink(session):
+        if session.watcher is not None:
+            session.watcher.stop()
+
+        if not session.sink_id:
+            return
+
+        log.info(f"[{app_name}] Unloading pulse sink {session.sink_name}")
+        if PulseAudio.client is not None:
+            PulseAudio.client.unload_module(session.sink_id)
+        else:
+            Shell.run(['pactl', 'unload-module', session.sink_id])
+        session.sink_id = ""
+
+    @staticmethod
+    def init_spotify_sink_input_id(session):
+        if session.spotify_sink_input_id > -1:
+            return
+
+        for index in PulseAudio.sink_inputs():
+            if PulseAudio.is_spotify_sink_input(session, index):
+                session.spotify_sink_input_id = index
+                break
+
+    # Returns the sink inputs (index -> (lowercase application name, process id)) parsed from pactl
+    @staticmethod
+    def list_sink_inputs():
+        sink_inputs = {}
+        index = -1
+
+        for line in Shell.check_output(["pactl", "list", "sink-inputs"], c_locale=True).split('\n'):
+            line = line.strip()
+            if line.startswith("Sink Input #"):
+                index = int(line.split("#", 1)[1])
+                sink_inputs[index] = ("", None)
+            elif index > -1 and "=" in line:
+                key, value = line.split("=", 1)
+                key = key.strip()
+                value = value.strip().strip('"')
+                name, pid = sink_inputs[index]
+                if key == "application.name":
+                    sink_inputs[index] = (value.lower(), pid)
+                elif key == "application.process.id" and value.isdigit():
+                    sink_inputs[index] = (name, int(value))
+
+        return sink_inputs
+
+    @staticmethod
+    def sink_inputs():
+        if PulseAudio.client is not None:
+            return dict(PulseAudio.client.sink_inputs)
+        return PulseAudio.list_sink_inputs()
+
+    # With several sessions the stream is matched by the process id of the player, which is known from DBus
+    @staticmethod
+    def is_spotify_sink_input(session, index: int):
+        name, pid = PulseAudio.sink_inputs().get(index, ("", None))
+        if name != PulseAudio.spotify_application_name:
+            return False
+        return len(_sessions) == 1 or session.spotify_pid is None or pid == session.spotify_pid
+
+    @staticmethod
+    def start_watcher(session):
+        session.watcher = SinkInputWatcher(session)
+        session.watcher.start()
+
+    # Runs in the SinkInputWatcher thread
+    @staticmethod
+    def move_spotify_to_own_sink(session):
+        if session.spotify_sink_input_id > -1:
+            if PulseAudio.client is not None:
+                success = PulseAudio.client.move_sink_input(
+                    session.spotify_sink_input_id, session.sink_name)
+            else:
+                success = Shell.run(["pactl", "move-sink-input", str(
+                    session.spotify_sink_input_id), session.sink_name]).returncode == 0
+
+            if success:
+                log.info(
+                    f"[{app_name}] Moved Spotify to own sink {session.sink_name}")
+            else:
+                log.warning(
+                    f"[{app_name}] Failed to move Spotify to own sink {session.sink_name}")
+
+            return success
+
+        return False
+
+    @staticmethod
+    def set_sink_volumes_to_100(session):
         log.debug(f"[{app_name}] Set sink volumes to 100%")
 
+        if PulseAudio.client is not None:
+            PulseAudio.client.set_sink_input_volume(
+                session.spotify_sink_input_id, 1.0)
+            PulseAudio.client.set_sink_volume(session.sink_name, 1.0)
+            return
+
         # Set Spotify volume to 100%
-        Shell.Popen("pactl set-sink-input-volume " +
-                    str(pa_spotify_sink_input_id) + " " + _pa_max_volume)
+        Shell.Popen(["pactl", "set-sink-input-volume",
+                     str(session.spotify_sink_input_id), _pa_max_volume])
 
         # Set recording sink volume to 100%
-        Shell.Popen("pactl set-sink-volume " +
-                    _pa_recording_sink_name + " " + _pa_max_volume)
+        Shell.Popen(["pactl", "set-sink-volume",
+                     session.sink_name, _pa_max_volume])
 
 
 if __name__ == "__main__":